@@ -1,18 +1,128 @@
+"""Live pipeline progress and bottleneck stages across fanzines.
+
+Page counts come from Firestore count() aggregation queries, so checking a
+1,000-page fanzine costs a handful of reads instead of streaming every page.
+Stage timings come from the `pipeline_metrics/{fanzineId}/shards/*` rollups
+written by `functions/tracing.py`, added back together per fanzine. Time for
+images shared between fanzines is counted in each of them (see
+`sharedWallMs`), so the overall bottleneck can overstate those stages.
+
+Usage:
+    python check_firestore_status.py                 # fanzines still processing
+    python check_firestore_status.py FID [FID ...]   # specific fanzines
+    python check_firestore_status.py --all --limit 50
+"""
+import argparse
+
 import firebase_admin
 from firebase_admin import firestore
 
 if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
-db = firestore.client()
-fid = "ZRK4fYci8LFX0qP3Q0hh"
-fref = db.collection('fanzines').document(fid)
-data = fref.get().to_dict()
+PAGE_STATUSES = ['ready', 'queued', 'transcribed', 'error']
+STAGE_ORDER = ['ingest', 'ocr', 'cleaning', 'linking', 'indexing', 'thumbnails', 'tiles', 'aggregation']
+SETTLED_STATUSES = ['complete', 'idle']
+
+
+def count(query):
+    """Runs a count() aggregation and returns the number of matches."""
+    return query.count(alias='n').get()[0][0].value
+
+
+def page_progress(fref):
+    pages = fref.collection('pages')
+    progress = {'total': count(pages)}
+    for status in PAGE_STATUSES:
+        progress[status] = count(pages.where(filter=firestore.FieldFilter('status', '==', status)))
+    return progress
+
+
+def merge_shards(shards):
+    """Adds metric shard dicts back into one: counters are summed, maxWallMs
+    takes the max, and lastStage/lastError come from the latest shard."""
+    merged = {'stages': {}}
+    for shard in shards:
+        for name, stats in shard.get('stages', {}).items():
+            into = merged['stages'].setdefault(name, {})
+            for k, v in stats.items():
+                into[k] = max(into.get(k, 0), v) if k == 'maxWallMs' else into.get(k, 0) + v
+    by_update = [s for s in shards if s.get('updatedAt')]
+    if by_update: merged['lastStage'] = max(by_update, key=lambda s: s['updatedAt']).get('lastStage')
+    by_error = [s for s in shards if s.get('lastErrorAt')]
+    if by_error: merged['lastError'] = max(by_error, key=lambda s: s['lastErrorAt']).get('lastError')
+    return merged
+
+
+def load_metrics(db, fanzine_id):
+    shards = db.collection('pipeline_metrics').document(fanzine_id).collection('shards').stream()
+    return merge_shards([s.to_dict() for s in shards])
+
+
+def stage_summary(metrics):
+    """Returns [(stage, stats)] in pipeline order, then any unknown stages."""
+    stages = metrics.get('stages', {})
+    ordered = [s for s in STAGE_ORDER if s in stages] + sorted(s for s in stages if s not in STAGE_ORDER)
+    return [(s, stages[s]) for s in ordered]
+
+
+def bottleneck(stages):
+    """The stage with the most traced wall time, and its share of the total."""
+    total = sum(s.get('wallMs', 0) for _, s in stages)
+    if not total: return None, 0.0
+    name, stats = max(stages, key=lambda item: item[1].get('wallMs', 0))
+    return name, stats.get('wallMs', 0) / total
+
+
+def report(fanzine, metrics):
+    data = fanzine.to_dict()
+    progress = page_progress(fanzine.reference)
+    print(f"\nFanzine: {data.get('title')} ({fanzine.id})")
+    print(f"  status: {data.get('processingStatus')}  pages: {progress['total']}  deduplicated: {data.get('dedupedPages', 0)}")
+    print("  pages: " + " | ".join(f"{s} {progress[s]}" for s in PAGE_STATUSES))
+
+    stages = stage_summary(metrics)
+    for name, s in stages:
+        n = s.get('count', 0)
+        avg = s.get('wallMs', 0) / n if n else 0
+        ext = s.get('externalMs', 0) / n if n else 0
+        print(f"  {name:<12} runs {n:>5}  errors {s.get('errors', 0):>4}  avg {avg:>8.0f}ms  "
+              f"max {s.get('maxWallMs', 0):>8.0f}ms  external avg {ext:>8.0f}ms  "
+              f"retries {s.get('retries', 0):>4}  tokens {s.get('promptTokens', 0) + s.get('outputTokens', 0)}"
+              + (f"  shared {s['sharedWallMs'] / 1000:.0f}s" if s.get('sharedWallMs') else ""))
+
+    name, share = bottleneck(stages)
+    if name: print(f"  bottleneck: {name} ({share:.0%} of traced time)")
+    if metrics.get('lastError'): print(f"  last error: {metrics['lastError']}")
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show pipeline progress for fanzines.")
+    parser.add_argument('fanzine_ids', nargs='*')
+    parser.add_argument('--all', action='store_true', help="Include fanzines that have finished processing.")
+    parser.add_argument('--limit', type=int, default=25)
+    args = parser.parse_args()
+
+    db = firestore.client()
+    if args.fanzine_ids:
+        fanzines = [f for f in db.get_all([db.collection('fanzines').document(fid) for fid in args.fanzine_ids]) if f.exists]
+    else:
+        query = db.collection('fanzines')
+        if not args.all:
+            query = query.where(filter=firestore.FieldFilter('processingStatus', 'not-in', SETTLED_STATUSES))
+        fanzines = list(query.limit(args.limit).stream())
+
+    overall = {}
+    for fanzine in fanzines:
+        for name, s in report(fanzine, load_metrics(db, fanzine.id)):
+            overall[name] = overall.get(name, 0) + s.get('wallMs', 0)
+
+    print(f"\n{len(fanzines)} fanzine(s) checked.")
+    if overall:
+        name, share = bottleneck([(n, {'wallMs': ms}) for n, ms in overall.items()])
+        print(f"Overall bottleneck: {name} ({share:.0%} of traced time)")
 
-print(f"Fanzine: {data.get('title')} ({fid})")
-print(f"Status: {data.get('processingStatus')}")
 
-pages_ref = fref.collection('pages').order_by('pageNumber').stream()
-for p in pages_ref:
-    pdata = p.to_dict()
-    print(f"Page {pdata.get('pageNumber')}: {pdata.get('status')} - Error: {pdata.get('errorLog')}")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Perceptual-hash deduplication of page images across fanzines.
+
+Every ingested page gets a difference hash (dHash): the page is shrunk to a
+(HASH_SIZE + 1) x HASH_SIZE greyscale thumbnail and each bit records whether
+a pixel is brighter than its right-hand neighbour. Rescans, reprints and
+reused covers land within a few bits of each other regardless of render
+resolution or JPEG noise.
+
+To find near-duplicates without scanning the archive, the hash is split
+into HASH_BANDS equal bands that are stored as an indexed array. If two
+hashes differ in at most HASH_BANDS - 1 bits, at least one band must match
+exactly (pigeonhole), so a single `array_contains_any` query returns every
+candidate and the exact Hamming distance is checked in memory.
+
+Uniform bands (all 0 or all 1 bits) come from blank margins and empty
+half-pages, which most of the archive shares, so they are left out of the
+index; recall is then guaranteed up to one bit fewer than the number of
+informative bands. The lookup is also capped at MAX_CANDIDATES docs.
+"""
+from PIL import Image, ImageStat
+
+HASH_SIZE = 16  # 16 x 16 = 256-bit hash
+HASH_BANDS = 8  # 32-bit bands -> guaranteed recall up to 7 differing bits
+DEFAULT_MAX_DISTANCE = 6
+MAX_CANDIDATES = 50
+
+# Near-blank pages (end papers, blank versos) all hash alike, so they are never
+# merged. Measured as the greyscale standard deviation of the hash thumbnail.
+MIN_CONTRAST = 6.0
+
+
+def dhash(img, hash_size=HASH_SIZE):
+    """Returns the difference hash of an image as a hex string."""
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    px = small.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (px[offset + col] > px[offset + col + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def is_low_information(img, hash_size=HASH_SIZE):
+    """True for pages too uniform for their hash to identify them."""
+    small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    return ImageStat.Stat(small).stddev[0] < MIN_CONTRAST
+
+
+def _is_uniform(band):
+    return band.strip('0') == '' or band.strip('f') == ''
+
+
+def hash_bands(hex_hash, bands=HASH_BANDS):
+    """Splits a hash into position-tagged bands for the lookup index.
+
+    Uniform bands are dropped (see the module docstring), so this may return
+    fewer than `bands` entries, or none for a page with no usable band.
+    """
+    width = len(hex_hash) // bands
+    chunks = [hex_hash[i * width:(i + 1) * width] for i in range(bands)]
+    return [f"{i}:{c}" for i, c in enumerate(chunks) if not _is_uniform(c)]
+
+
+def hamming(hash_a, hash_b):
+    """Number of differing bits between two hex hashes."""
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def ranked_matches(hex_hash, candidates, max_distance):
+    """Lists candidates within `max_distance` bits, closest first.
+
+    Args:
+        hex_hash: Hash of the page being ingested.
+        candidates: Iterable of (candidate_hash, payload) pairs.
+        max_distance: Largest Hamming distance still treated as a duplicate.
+
+    Returns:
+        List of (payload, distance) pairs sorted by distance.
+    """
+    found = []
+    for cand_hash, payload in candidates:
+        dist = hamming(hex_hash, cand_hash)
+        if dist <= max_distance: found.append((payload, dist))
+    return sorted(found, key=lambda m: m[1])
+
+
+def best_match(hex_hash, candidates, max_distance):
+    """Picks the closest candidate; (payload, distance) or (None, None)."""
+    ranked = ranked_matches(hex_hash, candidates, max_distance)
+    return ranked[0] if ranked else (None, None)
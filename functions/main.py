@@ -3,7 +3,6 @@ import time
 import json
 import tempfile
 import re
-import traceback
 import urllib.request
 import urllib.parse
 from io import BytesIO
@@ -12,21 +11,34 @@ from PIL import Image
 import firebase_admin
 from firebase_admin import firestore, storage
 from firebase_functions import storage_fn, https_fn, firestore_fn
-from firebase_functions.params import SecretParam
+from firebase_functions.params import SecretParam, IntParam
 
 # The new Google Gen AI SDK
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
 
 # Google Cloud Vision for bulletproof OCR
 from google.cloud import vision
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.storage.retry import DEFAULT_RETRY as STORAGE_RETRY
 
-# Initialize Firebase Admin
-firebase_admin.initialize_app()
+import dedup
+import search_index
+import tiles
+import tracing
+
+# Initialize Firebase Admin (the local pipeline runner may already have done so for the emulators)
+if not firebase_admin._apps:
+    firebase_admin.initialize_app()
 
 # Define Secret for Gemini API Key
 GEMINI_API_KEY = SecretParam('GEMINI_API_KEY')
 
+# Max Hamming distance (in bits of the 256-bit dHash) for two pages to be merged
+# at ingest. Values above dedup.HASH_BANDS - 1 may miss some matches; -1 disables.
+DEDUP_MAX_DISTANCE = IntParam('DEDUP_MAX_DISTANCE', default=dedup.DEFAULT_MAX_DISTANCE)
+
 # --------------------------------------------------------------------------------
 # HELPERS
 # --------------------------------------------------------------------------------
@@ -68,6 +80,22 @@ def extract_json_from_text(text):
     try: return json.loads(clean.strip())
     except: raise ValueError("Failed to extract valid JSON from response.")
 
+GEMINI_ATTEMPTS = 3
+
+# Total time Vision may spend retrying transient errors; ocr_worker has 120s in all.
+VISION_RETRY_TIMEOUT_S = 30
+
+def _generate_content(client, trace, **kwargs):
+    """Calls Gemini, retrying rate limits and server errors with backoff."""
+    for attempt in range(GEMINI_ATTEMPTS):
+        try:
+            with trace.external_call('gemini'):
+                return client.models.generate_content(**kwargs)
+        except genai_errors.APIError as e:
+            if attempt + 1 >= GEMINI_ATTEMPTS or not (e.code == 429 or e.code >= 500): raise
+            trace.retry()
+            time.sleep(2 ** attempt)
+
 def generate_simple_shortcode():
     import random
     import string
@@ -136,6 +164,8 @@ def fanzine_traffic_manager(event: firestore_fn.Event[firestore_fn.Change[firest
         pages = fref.collection('pages').stream()
         batch = db.batch()
         for p in pages:
+            # Pages merged into an already-transcribed image at ingest have its text.
+            if p.to_dict().get('status') == 'transcribed': continue
             batch.update(p.reference, {'status': 'queued'})
         batch.commit()
     elif status == 'ready_for_agg':
@@ -156,58 +186,61 @@ def ocr_worker(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.Docume
     fanzine_id = event.params['fanzineId']
     image_id = data.get('imageId')
 
-    try:
-        vision_client = vision.ImageAnnotatorClient()
-        image = vision.Image()
-
-        storage_path = data.get('storagePath')
-        if storage_path:
-            bucket_name = storage.bucket().name
-            image.source.image_uri = f"gs://{bucket_name}/{storage_path}"
-        else:
-            image_url = data.get('imageUrl')
-            if not image_url: raise ValueError("No image source available for Vision API.")
-            req = urllib.request.Request(image_url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req) as res: image_bytes = res.read()
-            image.content = image_bytes
-
-        response = vision_client.document_text_detection(image=image)
-
-        if response.error.message:
-            raise Exception(f"Vision API Error: {response.error.message}")
-
-        transcription = response.full_text_annotation.text if response.full_text_annotation else "[No text detected]"
-
-        if not image_id:
-            new_img_ref = db.collection('images').document()
-            image_id = new_img_ref.id
-            new_img_ref.set({
-                'storagePath': storage_path,
-                'fileUrl': data.get('imageUrl', ''),
-                'shortCode': generate_simple_shortcode(),
-                'status': 'approved',
-                'timestamp': firestore.SERVER_TIMESTAMP,
-                'uploaderId': data.get('uploaderId', 'system_ingest'),
-                'text_raw': transcription,
-                'needs_ai_cleaning': True,
-                'folioContext': fanzine_id,
-                'usedInFanzines': [fanzine_id]
-            })
-            page_ref.update({'imageId': image_id})
-        else:
-            db.collection('images').document(image_id).update({
-                'text_raw': transcription,
-                'needs_ai_cleaning': True
-            })
+    with tracing.stage('ocr', fanzine_ids=[fanzine_id], page_id=event.params.get('pageId'), image_id=image_id) as trace:
+        try:
+            vision_client = vision.ImageAnnotatorClient()
+            image = vision.Image()
+
+            storage_path = data.get('storagePath')
+            if storage_path:
+                bucket_name = storage.bucket().name
+                image.source.image_uri = f"gs://{bucket_name}/{storage_path}"
+            else:
+                image_url = data.get('imageUrl')
+                if not image_url: raise ValueError("No image source available for Vision API.")
+                req = urllib.request.Request(image_url, headers={'User-Agent': 'Mozilla/5.0'})
+                with trace.external_call('http'), urllib.request.urlopen(req) as res: image_bytes = res.read()
+                trace.add_bytes(bytes_in=len(image_bytes))
+                image.content = image_bytes
+
+            with trace.external_call('vision'):
+                response = vision_client.document_text_detection(image=image, retry=trace.retry_policy(timeout=VISION_RETRY_TIMEOUT_S))
+
+            if response.error.message:
+                raise Exception(f"Vision API Error: {response.error.message}")
+
+            transcription = response.full_text_annotation.text if response.full_text_annotation else "[No text detected]"
+
+            if not image_id:
+                new_img_ref = db.collection('images').document()
+                image_id = new_img_ref.id
+                new_img_ref.set({
+                    'storagePath': storage_path,
+                    'fileUrl': data.get('imageUrl', ''),
+                    'shortCode': generate_simple_shortcode(),
+                    'status': 'approved',
+                    'timestamp': firestore.SERVER_TIMESTAMP,
+                    'uploaderId': data.get('uploaderId', 'system_ingest'),
+                    'text_raw': transcription,
+                    'needs_ai_cleaning': True,
+                    'folioContext': fanzine_id,
+                    'usedInFanzines': [fanzine_id]
+                })
+                page_ref.update({'imageId': image_id})
+            else:
+                db.collection('images').document(image_id).update({
+                    'text_raw': transcription,
+                    'needs_ai_cleaning': True
+                })
 
-        page_ref.update({
-            'status': 'transcribed',
-            'processedAt': firestore.SERVER_TIMESTAMP
-        })
+            page_ref.update({
+                'status': 'transcribed',
+                'processedAt': firestore.SERVER_TIMESTAMP
+            })
 
-    except Exception as e:
-        print(f"Transcription Error: {traceback.format_exc()}")
-        page_ref.update({'status': 'error', 'errorLog': f"Transcription: {str(e)}"})
+        except Exception as e:
+            trace.fail(e)
+            page_ref.update({'status': 'error', 'errorLog': f"Transcription: {str(e)}"})
 
 # --------------------------------------------------------------------------------
 # WORKER 2: AI FORMATTING & CORRECTION -> writes to text_corrected
@@ -229,25 +262,24 @@ def ai_cleaning_worker(event: firestore_fn.Event[firestore_fn.Change[firestore_f
         })
         return
 
-    try:
-        client = genai.Client(api_key=GEMINI_API_KEY.value)
-        prompt = f"Clean up the following raw OCR text from a fanzine. Fix typos, standardize headers, and format it properly as markdown. Do not add conversational filler. Output only the cleaned text.\n\nText:\n{text_raw}"
+    with tracing.stage('cleaning', fanzine_ids=data.get('usedInFanzines', []), image_id=event.params['imageId']) as trace:
+        try:
+            client = genai.Client(api_key=GEMINI_API_KEY.value)
+            prompt = f"Clean up the following raw OCR text from a fanzine. Fix typos, standardize headers, and format it properly as markdown. Do not add conversational filler. Output only the cleaned text.\n\nText:\n{text_raw}"
 
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[prompt],
-        )
-        clean_text = response.text.strip()
+            response = _generate_content(client, trace, model="gemini-2.5-flash", contents=[prompt])
+            trace.add_gemini_usage(response)
+            clean_text = response.text.strip()
 
-        event.data.after.reference.update({
-            'text_corrected': clean_text,
-            'text_corrected_ai': clean_text,
-            'needs_ai_cleaning': False,
-            'needs_linking': True
-        })
-    except Exception as e:
-        print(f"AI Cleaning Error: {traceback.format_exc()}")
-        event.data.after.reference.update({'errorLog_cleaning': str(e), 'needs_ai_cleaning': False})
+            event.data.after.reference.update({
+                'text_corrected': clean_text,
+                'text_corrected_ai': clean_text,
+                'needs_ai_cleaning': False,
+                'needs_linking': True
+            })
+        except Exception as e:
+            trace.fail(e)
+            event.data.after.reference.update({'errorLog_cleaning': str(e), 'needs_ai_cleaning': False})
 
 # --------------------------------------------------------------------------------
 # WORKER 3: ENTITY LINKING -> writes to text_linked
@@ -257,7 +289,15 @@ def linking_worker(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.Do
     if not event.data.after or not event.data.after.exists: return
     data = event.data.after.to_dict()
 
-    if not data.get('needs_linking'): return
+    db = firestore.client()
+    image_id = event.params['imageId']
+
+    if not data.get('needs_linking'):
+        # Indexing that failed after linking is requeued via this flag
+        if data.get('needs_indexing'):
+            _run_search_indexing(db, image_id, data.get('text_corrected', ''), data.get('detected_entities', []),
+                                 data.get('usedInFanzines', []), attempts=data.get('indexing_attempts', 0))
+        return
 
     text_corrected = data.get('text_corrected', '')
     if not text_corrected:
@@ -266,66 +306,152 @@ def linking_worker(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.Do
             'text_linked': '',
             'text_linked_ai': ''
         })
+        _run_search_indexing(db, image_id, '', [], data.get('usedInFanzines', []))
         return
 
-    db = firestore.client()
-    try:
-        client = genai.Client(api_key=GEMINI_API_KEY.value)
-        prompt = f"Identify people, groups, or entities in this text. Return a JSON array of strings containing their names exactly as they appear in the text: {text_corrected}"
-
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[prompt],
-            config=types.GenerateContentConfig(response_mime_type="application/json")
-        )
-        ents = extract_json_from_text(response.text)
-        clean_ents = [normalize_entity(e) for e in ents if normalize_entity(e)] if isinstance(ents, list) else []
-
-        text_linked = text_corrected
-        clean_ents.sort(key=lambda x: len(x), reverse=True)
-
-        for ent in clean_ents:
-            if not ent: continue
-
-            # Check database for exact handle/UID redirect
-            handle = ent.lower().replace(' ', '-')
-            handle = re.sub(r'[^a-z0-9-]', '', handle)
-            user_doc = db.collection('usernames').document(handle).get()
-
-            replacement = f"[[{ent}]]"
-            if user_doc.exists:
-                u_data = user_doc.to_dict()
-                if 'redirect' in u_data:
-                    target_handle = u_data['redirect']
-                    target_doc = db.collection('usernames').document(target_handle).get()
-                    if target_doc.exists:
-                        target_uid = target_doc.to_dict().get('uid')
-                        if target_uid: replacement = f"[[{ent}|user:{target_uid}]]"
-                elif 'uid' in u_data:
-                    replacement = f"[[{ent}|user:{u_data['uid']}]]"
-
-            escaped_name = re.escape(ent)
-            pattern = re.compile(r'(?<!\[)(' + escaped_name + r')(?!\])', re.IGNORECASE)
-            text_linked = pattern.sub(replacement, text_linked)
+    with tracing.stage('linking', fanzine_ids=data.get('usedInFanzines', []), image_id=image_id) as trace:
+        try:
+            client = genai.Client(api_key=GEMINI_API_KEY.value)
+            prompt = f"Identify people, groups, or entities in this text. Return a JSON array of strings containing their names exactly as they appear in the text: {text_corrected}"
+
+            response = _generate_content(
+                client, trace,
+                model="gemini-2.5-flash",
+                contents=[prompt],
+                config=types.GenerateContentConfig(response_mime_type="application/json")
+            )
+            trace.add_gemini_usage(response)
+            ents = extract_json_from_text(response.text)
+            clean_ents = [normalize_entity(e) for e in ents if normalize_entity(e)] if isinstance(ents, list) else []
+
+            text_linked = text_corrected
+            clean_ents.sort(key=lambda x: len(x), reverse=True)
+
+            for ent in clean_ents:
+                if not ent: continue
+
+                # Check database for exact handle/UID redirect
+                handle = ent.lower().replace(' ', '-')
+                handle = re.sub(r'[^a-z0-9-]', '', handle)
+                user_doc = db.collection('usernames').document(handle).get()
+
+                replacement = f"[[{ent}]]"
+                if user_doc.exists:
+                    u_data = user_doc.to_dict()
+                    if 'redirect' in u_data:
+                        target_handle = u_data['redirect']
+                        target_doc = db.collection('usernames').document(target_handle).get()
+                        if target_doc.exists:
+                            target_uid = target_doc.to_dict().get('uid')
+                            if target_uid: replacement = f"[[{ent}|user:{target_uid}]]"
+                    elif 'uid' in u_data:
+                        replacement = f"[[{ent}|user:{u_data['uid']}]]"
+
+                escaped_name = re.escape(ent)
+                pattern = re.compile(r'(?<!\[)(' + escaped_name + r')(?!\])', re.IGNORECASE)
+                text_linked = pattern.sub(replacement, text_linked)
+
+            event.data.after.reference.update({
+                'text_linked': text_linked,
+                'text_linked_ai': text_linked,
+                'needs_linking': False,
+                'detected_entities': clean_ents
+            })
 
-        event.data.after.reference.update({
-            'text_linked': text_linked,
-            'text_linked_ai': text_linked,
-            'needs_linking': False,
-            'detected_entities': clean_ents
-        })
+            # FIXED: Bubble up these extracted entities to the parent Fanzine so they instantly appear in the Profile Entities Tab!
+            used_in = data.get('usedInFanzines', [])
+            if clean_ents and used_in:
+                for fid in used_in:
+                    db.collection('fanzines').document(fid).update({
+                        'draftEntities': firestore.ArrayUnion(clean_ents)
+                    })
 
-        # FIXED: Bubble up these extracted entities to the parent Fanzine so they instantly appear in the Profile Entities Tab!
-        used_in = data.get('usedInFanzines', [])
-        if clean_ents and used_in:
-            for fid in used_in:
-                db.collection('fanzines').document(fid).update({
-                    'draftEntities': firestore.ArrayUnion(clean_ents)
-                })
+        except Exception as e:
+            trace.fail(e)
+            event.data.after.reference.update({'errorLog_linking': str(e), 'needs_linking': False})
+            return
 
-    except Exception as e:
-        print(f"Linking Error: {traceback.format_exc()}")
-        event.data.after.reference.update({'errorLog_linking': str(e), 'needs_linking': False})
+    _run_search_indexing(db, image_id, text_corrected, clean_ents, data.get('usedInFanzines', []))
+
+# --------------------------------------------------------------------------------
+# STAGE 5: SEARCH INDEXING (called at the end of linking_worker)
+# --------------------------------------------------------------------------------
+MAX_INDEX_ATTEMPTS = 3
+
+def _run_search_indexing(db, image_id, text, entities, fanzine_ids, attempts=0):
+    img_ref = db.collection('images').document(image_id)
+    with tracing.stage('indexing', fanzine_ids=fanzine_ids, image_id=image_id, attempt=attempts + 1) as trace:
+        if attempts: trace.retry()
+        try:
+            _update_search_index(db, image_id, text, entities)
+            if attempts:
+                img_ref.update({'needs_indexing': firestore.DELETE_FIELD, 'indexing_attempts': firestore.DELETE_FIELD, 'errorLog_indexing': firestore.DELETE_FIELD})
+        except Exception as e:
+            trace.fail(e)
+            # Requeue: the write below re-triggers linking_worker, which retries via needs_indexing
+            img_ref.update({
+                'errorLog_indexing': str(e),
+                'indexing_attempts': attempts + 1,
+                'needs_indexing': attempts + 1 < MAX_INDEX_ATTEMPTS
+            })
+
+def _update_search_index(db, image_id, text, entities):
+    """Diffs an image's terms against its last indexed state and patches postings."""
+    fwd_ref = db.collection('search_docs').document(image_id)
+    fwd = fwd_ref.get()
+    fwd_data = fwd.to_dict() if fwd.exists else {}
+    old_terms = fwd_data.get('terms', {})
+    old_gens = fwd_data.get('gens', {})
+    new_terms = search_index.build_terms(text, entities)
+    upserts, removals = search_index.diff_terms(old_terms, new_terms)
+    if not upserts and not removals: return
+
+    lane = search_index.lane_for(image_id)
+    postings = db.collection('search_postings')
+    heads = db.collection('search_terms')
+    batch = db.batch()
+    batch_count = 0
+
+    # Postings the image already has stay in their chunk; new ones go to the lane's open chunk.
+    gens = {k: old_gens.get(k, 0) for k in new_terms if k in old_terms}
+    fresh = [k for k in upserts if k not in old_terms]
+    if fresh:
+        gens.update({k: 0 for k in fresh})
+        for snap in db.get_all([heads.document(k) for k in fresh]):
+            if snap.exists: gens[snap.id] = (snap.to_dict() or {}).get('gens', {}).get(str(lane), 0)
+        chunk_refs = [postings.document(search_index.posting_doc_id(k, lane, gens[k])) for k in fresh]
+        sizes = {s.id: (s.to_dict() or {}).get('size', 0) for s in db.get_all(chunk_refs, field_paths=['size']) if s.exists}
+        for key in fresh:
+            size = sizes.get(search_index.posting_doc_id(key, lane, gens[key]), 0)
+            if size + search_index.posting_size(image_id, upserts[key]) <= search_index.CHUNK_MAX_BYTES: continue
+            # Spill to the next gen. Concurrent writers compute the same gen, so Maximum keeps it idempotent.
+            gens[key] += 1
+            batch.set(heads.document(key), {'gens': {str(lane): firestore.Maximum(gens[key])}}, merge=True)
+            batch_count += 1
+
+    writes = []
+    for key, value in upserts.items():
+        delta = search_index.posting_size(image_id, value) - (search_index.posting_size(image_id, old_terms[key]) if key in old_terms else 0)
+        writes.append((key, gens[key], {'term': key, 'p': {image_id: value}, 'size': firestore.Increment(delta)}))
+    for key in removals:
+        delta = -search_index.posting_size(image_id, old_terms[key])
+        writes.append((key, old_gens.get(key, 0), {'p': {image_id: firestore.DELETE_FIELD}, 'size': firestore.Increment(delta)}))
+
+    for key, gen, fields in writes:
+        batch.set(postings.document(search_index.posting_doc_id(key, lane, gen)), fields, merge=True)
+        batch_count += 1
+        if batch_count >= 400:
+            batch.commit()
+            batch = db.batch()
+            batch_count = 0
+
+    # Forward doc goes last: if a batch above fails, the next run re-diffs from the old state.
+    batch.set(fwd_ref, {
+        'terms': new_terms,
+        'gens': {k: g for k, g in gens.items() if g and k in new_terms},
+        'indexedAt': firestore.SERVER_TIMESTAMP
+    })
+    batch.commit()
 
 # --------------------------------------------------------------------------------
 # WORKER 4: IMAGE RESIZING (THUMBNAIL GENERATOR)
@@ -350,130 +476,315 @@ def generate_thumbnails(event: firestore_fn.Event[firestore_fn.Change[firestore_
 
     img_ref.update({'processing_thumbnails': True})
 
+    with tracing.stage('thumbnails', fanzine_ids=data.get('usedInFanzines', []), image_id=image_id) as trace:
+        try:
+            if storage_path:
+                blob = bucket.blob(storage_path)
+                with trace.external_call('storage'):
+                    image_bytes = blob.download_as_bytes(retry=trace.retry_policy(STORAGE_RETRY))
+            else:
+                req = urllib.request.Request(file_url, headers={'User-Agent': 'Mozilla/5.0'})
+                with trace.external_call('http'), urllib.request.urlopen(req) as res: image_bytes = res.read()
+            trace.add_bytes(bytes_in=len(image_bytes))
+
+            img = Image.open(BytesIO(image_bytes))
+            if img.mode in ("RGBA", "P"): img = img.convert("RGB")
+            orig_w, orig_h = img.size
+
+            def resize_and_upload(target_w, suffix):
+                ratio = target_w / orig_w if orig_w > target_w else 1
+                resized = img.resize((target_w, int(orig_h * ratio)), Image.Resampling.LANCZOS)
+                out_io = BytesIO()
+                resized.save(out_io, format='WEBP', quality=80)
+                trace.add_bytes(bytes_out=out_io.tell())
+                out_io.seek(0)
+
+                dest_path = f"thumbnails/{image_id}_{suffix}.webp"
+                new_blob = bucket.blob(dest_path)
+                with trace.external_call('storage'):
+                    new_blob.upload_from_file(out_io, content_type="image/webp")
+
+                    new_blob.metadata = {"firebaseStorageDownloadTokens": image_id}
+                    new_blob.patch()
+
+                return f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/{urllib.parse.quote(dest_path, safe='')}?alt=media&token={image_id}"
+
+            grid_url = resize_and_upload(450, 'grid')
+            list_url = resize_and_upload(800, 'list')
+
+            img_ref.update({
+                'gridUrl': grid_url,
+                'listUrl': list_url,
+                'processing_thumbnails': firestore.DELETE_FIELD,
+                'width': orig_w,
+                'height': orig_h
+            })
+
+            # Sync URLs to pages
+            used_in = data.get('usedInFanzines', [])
+            for fid in used_in:
+                pages = db.collection('fanzines').document(fid).collection('pages').where(filter=firestore.FieldFilter('imageId', '==', image_id)).stream()
+                for p in pages:
+                    p.reference.update({'gridUrl': grid_url, 'listUrl': list_url, 'width': orig_w, 'height': orig_h})
+
+        except Exception as e:
+            trace.fail(e)
+            img_ref.update({'thumbnail_error': str(e), 'processing_thumbnails': firestore.DELETE_FIELD})
+
+# --------------------------------------------------------------------------------
+# WORKER 5: DEEP-ZOOM TILE PYRAMID -> writes tileManifestUrl
+# --------------------------------------------------------------------------------
+@firestore_fn.on_document_written(document="images/{imageId}", memory=2048, cpu=2, timeout_sec=300)
+def generate_tile_pyramid(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot]]) -> None:
+    if not event.data.after or not event.data.after.exists: return
+    data = event.data.after.to_dict()
+
+    file_url = data.get('fileUrl')
+    storage_path = data.get('storagePath')
+    if not file_url and not storage_path: return
+
+    # Idempotency check
+    if data.get('tileManifestUrl') or data.get('tile_error'): return
+    if data.get('processing_tiles'): return
+
+    db = firestore.client()
+    bucket = storage.bucket()
+    image_id = event.params['imageId']
+    img_ref = db.collection('images').document(image_id)
+
+    # Claim the job only if the image is unchanged since this event's snapshot, so the
+    # burst of OCR/cleaning/linking writes can't each start a full pyramid build.
     try:
-        if storage_path:
-            blob = bucket.blob(storage_path)
-            image_bytes = blob.download_as_bytes()
-        else:
-            req = urllib.request.Request(file_url, headers={'User-Agent': 'Mozilla/5.0'})
-            with urllib.request.urlopen(req) as res: image_bytes = res.read()
-
-        img = Image.open(BytesIO(image_bytes))
-        if img.mode in ("RGBA", "P"): img = img.convert("RGB")
-        orig_w, orig_h = img.size
-
-        def resize_and_upload(target_w, suffix):
-            ratio = target_w / orig_w if orig_w > target_w else 1
-            resized = img.resize((target_w, int(orig_h * ratio)), Image.Resampling.LANCZOS)
-            out_io = BytesIO()
-            resized.save(out_io, format='WEBP', quality=80)
-            out_io.seek(0)
-
-            dest_path = f"thumbnails/{image_id}_{suffix}.webp"
-            new_blob = bucket.blob(dest_path)
-            new_blob.upload_from_file(out_io, content_type="image/webp")
-
-            new_blob.metadata = {"firebaseStorageDownloadTokens": image_id}
-            new_blob.patch()
-
-            return f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/{urllib.parse.quote(dest_path, safe='')}?alt=media&token={image_id}"
-
-        grid_url = resize_and_upload(450, 'grid')
-        list_url = resize_and_upload(800, 'list')
-
-        img_ref.update({
-            'gridUrl': grid_url,
-            'listUrl': list_url,
-            'processing_thumbnails': firestore.DELETE_FIELD,
-            'width': orig_w,
-            'height': orig_h
-        })
+        img_ref.update({'processing_tiles': True}, option=db.write_option(last_update_time=event.data.after.update_time))
+    except FailedPrecondition:
+        return # A later write (or another worker) got there first
+
+    with tracing.stage('tiles', fanzine_ids=data.get('usedInFanzines', []), image_id=image_id) as trace:
+        try:
+            if storage_path:
+                with trace.external_call('storage'):
+                    image_bytes = bucket.blob(storage_path).download_as_bytes(retry=trace.retry_policy(STORAGE_RETRY))
+            else:
+                req = urllib.request.Request(file_url, headers={'User-Agent': 'Mozilla/5.0'})
+                with trace.external_call('http'), urllib.request.urlopen(req) as res: image_bytes = res.read()
+            trace.add_bytes(bytes_in=len(image_bytes))
+
+            img = Image.open(BytesIO(image_bytes))
+            orig_w, orig_h = img.size
+            prefix = f"tiles/{image_id}"
+
+            def upload_tile(level, col, row, tile_bytes):
+                tile_blob = bucket.blob(tiles.tile_path(prefix, level, col, row))
+                # Metadata is sent with the upload, so no extra patch() round trip per tile.
+                tile_blob.metadata = {"firebaseStorageDownloadTokens": image_id}
+                tile_blob.cache_control = "public, max-age=31536000, immutable"
+                with trace.external_call('storage'):
+                    tile_blob.upload_from_string(tile_bytes, content_type="image/webp")
+                trace.add_bytes(bytes_out=len(tile_bytes))
+
+            tile_count = tiles.generate_tiles(img, upload_tile)
+
+            # Firebase download URLs encode the whole object path, so the viewer gets a
+            # template to fill in rather than DZI-relative paths.
+            template_path = urllib.parse.quote(tiles.tile_path(prefix, '{level}', '{col}', '{row}'), safe='{}')
+            tile_url_template = f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/{template_path}?alt=media&token={image_id}"
+            manifest = tiles.build_manifest(orig_w, orig_h, tile_url_template)
+
+            manifest_path = f"{prefix}/manifest.json"
+            manifest_blob = bucket.blob(manifest_path)
+            manifest_blob.metadata = {"firebaseStorageDownloadTokens": image_id}
+            manifest_blob.upload_from_string(json.dumps(manifest), content_type="application/json")
+            manifest_url = f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/{urllib.parse.quote(manifest_path, safe='')}?alt=media&token={image_id}"
+
+            img_ref.update({
+                'tileManifestUrl': manifest_url,
+                'tileCount': tile_count,
+                'processing_tiles': firestore.DELETE_FIELD
+            })
 
-        # Sync URLs to pages
-        used_in = data.get('usedInFanzines', [])
-        for fid in used_in:
-            pages = db.collection('fanzines').document(fid).collection('pages').where(filter=firestore.FieldFilter('imageId', '==', image_id)).stream()
-            for p in pages:
-                p.reference.update({'gridUrl': grid_url, 'listUrl': list_url, 'width': orig_w, 'height': orig_h})
+            # Sync manifest to pages
+            used_in = data.get('usedInFanzines', [])
+            for fid in used_in:
+                pages = db.collection('fanzines').document(fid).collection('pages').where(filter=firestore.FieldFilter('imageId', '==', image_id)).stream()
+                for p in pages:
+                    p.reference.update({'tileManifestUrl': manifest_url})
 
-    except Exception as e:
-        print(f"Thumbnail Error: {traceback.format_exc()}")
-        img_ref.update({'thumbnail_error': str(e), 'processing_thumbnails': firestore.DELETE_FIELD})
+        except Exception as e:
+            trace.fail(e)
+            img_ref.update({'tile_error': str(e), 'processing_tiles': firestore.DELETE_FIELD})
 
 # --------------------------------------------------------------------------------
 # PDF INGEST LOGIC
 # --------------------------------------------------------------------------------
 
+def _find_duplicate_image(db, fanzine_id, page_hash, page_bands, seen, max_distance):
+    """Returns (image_id, image_data, distance) of a near-duplicate, or Nones.
+
+    `seen` holds (hash, image_id, image_data) for pages earlier in the same PDF,
+    whose index entries may still be sitting in an uncommitted batch. Images used
+    only by `fanzine_id` itself are skipped, so a rescan re-runs OCR on its pages.
+    """
+    cand_ids = {}
+    query = db.collection('image_hashes').where(filter=firestore.FieldFilter('bands', 'array_contains_any', page_bands))
+    for h in query.limit(dedup.MAX_CANDIDATES).stream():
+        hd = h.to_dict()
+        cand_ids[hd['imageId']] = hd['hash']
+
+    local_id, local_dist = dedup.best_match(page_hash, [(h, (i, d)) for h, i, d in seen], max_distance)
+
+    for remote_id, remote_dist in dedup.ranked_matches(page_hash, [(h, i) for i, h in cand_ids.items()], max_distance):
+        if local_id and local_dist <= remote_dist: break
+        snap = db.collection('images').document(remote_id).get()
+        if not snap.exists:
+            # The image was deleted; drop its stale index entry and try the next closest
+            db.collection('image_hashes').document(remote_id).delete()
+            continue
+        remote = snap.to_dict()
+        if remote.get('usedInFanzines', []) == [fanzine_id]: continue # Our own previous scan
+        return remote_id, remote, remote_dist
+
+    if local_id: return local_id[0], local_id[1], local_dist
+    return None, None, None
+
 def _do_pdf_ingest(fanzine_id, file_path, uploader_id):
     import fitz  # PyMuPDF
     db = firestore.client()
     bucket = storage.bucket()
     fref = db.collection('fanzines').document(fanzine_id)
 
-    try:
-        blob = bucket.blob(file_path)
-        if not blob.exists(): raise Exception("Source PDF missing.")
-
-        pdf_bytes = blob.download_as_bytes()
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        n_pages = len(doc)
-
-        # Clear existing pages if rescan
-        for p in fref.collection('pages').stream(): p.reference.delete()
-
-        batch = db.batch()
-        batch_count = 0
-
-        for i in range(n_pages):
-            page_num = i + 1
-            page = doc.load_page(i)
-            pix = page.get_pixmap(matrix=fitz.Matrix(2.0, 2.0), alpha=False)
-            img_bytes = pix.tobytes("jpeg")
-
-            dest = f"fanzines/{fanzine_id}/pages/page_{page_num:03d}.jpg"
-            img_blob = bucket.blob(dest)
-
-            new_img_ref = db.collection('images').document()
-            token = new_img_ref.id
-            img_blob.metadata = {"firebaseStorageDownloadTokens": token}
-            img_blob.upload_from_string(img_bytes, content_type="image/jpeg")
-            img_blob.patch()
-
-            file_url = f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/{urllib.parse.quote(dest, safe='')}?alt=media&token={token}"
-
-            batch.set(new_img_ref, {
-                'storagePath': dest,
-                'fileUrl': file_url,
-                'shortCode': generate_simple_shortcode(),
-                'status': 'approved',
-                'timestamp': firestore.SERVER_TIMESTAMP,
-                'uploaderId': uploader_id,
-                'folioContext': fanzine_id,
-                'usedInFanzines': [fanzine_id]
-            })
+    with tracing.stage('ingest', fanzine_ids=[fanzine_id], source_file=file_path) as trace:
+        try:
+            blob = bucket.blob(file_path)
+            if not blob.exists(): raise Exception("Source PDF missing.")
+
+            with trace.external_call('storage'):
+                pdf_bytes = blob.download_as_bytes(retry=trace.retry_policy(STORAGE_RETRY))
+            trace.add_bytes(bytes_in=len(pdf_bytes))
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+            n_pages = len(doc)
+
+            # Clear existing pages if rescan
+            for p in fref.collection('pages').stream(): p.reference.delete()
+
+            batch = db.batch()
+            batch_count = 0
+            max_distance = DEDUP_MAX_DISTANCE.value
+            seen_hashes = []
+            merged, merged_ents = 0, set()
+
+            for i in range(n_pages):
+                page_num = i + 1
+                page = doc.load_page(i)
+                pix = page.get_pixmap(matrix=fitz.Matrix(2.0, 2.0), alpha=False)
+
+                # Near-duplicate pages link to the existing image instead of re-running the pipeline
+                page_img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+                page_hash = dedup.dhash(page_img)
+                page_bands = dedup.hash_bands(page_hash)
+                can_dedup = max_distance >= 0 and bool(page_bands) and not dedup.is_low_information(page_img)
+                dup_id, dup, dist = None, None, None
+                if can_dedup:
+                    with trace.external_call('dedup_lookup'):
+                        dup_id, dup, dist = _find_duplicate_image(db, fanzine_id, page_hash, page_bands, seen_hashes, max_distance)
+
+                if dup_id:
+                    batch.update(db.collection('images').document(dup_id), {'usedInFanzines': firestore.ArrayUnion([fanzine_id])})
+                    page_data = {
+                        'pageNumber': page_num,
+                        'storagePath': dup.get('storagePath'),
+                        'imageUrl': dup.get('fileUrl', ''),
+                        'imageId': dup_id,
+                        'dedupOf': dup_id,
+                        # Only skip OCR if the matched image actually has text; otherwise queue it
+                        'status': 'transcribed' if dup.get('text_raw') else 'ready',
+                        'uploadedAt': firestore.SERVER_TIMESTAMP
+                    }
+                    for k in ('gridUrl', 'listUrl', 'tileManifestUrl', 'width', 'height'):
+                        if dup.get(k): page_data[k] = dup[k]
+                    batch.set(fref.collection('pages').document(), page_data)
+                    batch.set(db.collection('dedup_merges').document(), {
+                        'imageId': dup_id,
+                        'fanzineId': fanzine_id,
+                        'pageNumber': page_num,
+                        'sourceFile': file_path,
+                        'hash': page_hash,
+                        'matchedHash': dup.get('phash'),
+                        'distance': dist,
+                        'maxDistance': max_distance,
+                        'createdAt': firestore.SERVER_TIMESTAMP
+                    })
+                    merged_ents.update(dup.get('detected_entities', []))
+                    merged += 1
+                    batch_count += 3
+                    if batch_count >= 400:
+                        batch.commit()
+                        batch = db.batch()
+                        batch_count = 0
+                    continue
+
+                img_bytes = pix.tobytes("jpeg")
+
+                new_img_ref = db.collection('images').document()
+                token = new_img_ref.id
+
+                # Keyed by image id so a rescan can't overwrite a blob that a merged page still points at
+                dest = f"fanzines/{fanzine_id}/pages/page_{page_num:03d}_{token}.jpg"
+                img_blob = bucket.blob(dest)
+                img_blob.metadata = {"firebaseStorageDownloadTokens": token}
+                with trace.external_call('storage'):
+                    img_blob.upload_from_string(img_bytes, content_type="image/jpeg")
+                    img_blob.patch()
+                trace.add_bytes(bytes_out=len(img_bytes))
+
+                file_url = f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/{urllib.parse.quote(dest, safe='')}?alt=media&token={token}"
+
+                batch.set(new_img_ref, {
+                    'storagePath': dest,
+                    'fileUrl': file_url,
+                    'shortCode': generate_simple_shortcode(),
+                    'status': 'approved',
+                    'timestamp': firestore.SERVER_TIMESTAMP,
+                    'uploaderId': uploader_id,
+                    'folioContext': fanzine_id,
+                    'usedInFanzines': [fanzine_id],
+                    'phash': page_hash
+                })
 
-            batch.set(fref.collection('pages').document(), {
-                'pageNumber': page_num,
-                'storagePath': dest,
-                'imageUrl': file_url,
-                'imageId': new_img_ref.id,
-                'status': 'ready',
-                'uploadedAt': firestore.SERVER_TIMESTAMP
-            })
+                if can_dedup:
+                    batch.set(db.collection('image_hashes').document(new_img_ref.id), {
+                        'imageId': new_img_ref.id,
+                        'hash': page_hash,
+                        'bands': page_bands,
+                        'createdAt': firestore.SERVER_TIMESTAMP
+                    })
+                    seen_hashes.append((page_hash, new_img_ref.id, {'storagePath': dest, 'fileUrl': file_url, 'phash': page_hash}))
+                    batch_count += 1
+
+                batch.set(fref.collection('pages').document(), {
+                    'pageNumber': page_num,
+                    'storagePath': dest,
+                    'imageUrl': file_url,
+                    'imageId': new_img_ref.id,
+                    'status': 'ready',
+                    'uploadedAt': firestore.SERVER_TIMESTAMP
+                })
 
-            batch_count += 2
-            if batch_count >= 400:
-                batch.commit()
-                batch = db.batch()
-                batch_count = 0
+                batch_count += 2
+                if batch_count >= 400:
+                    batch.commit()
+                    batch = db.batch()
+                    batch_count = 0
 
-        if batch_count > 0: batch.commit()
-        doc.close()
-        fref.update({'processingStatus': 'images_ready', 'pageCount': n_pages})
+            if batch_count > 0: batch.commit()
+            doc.close()
+            update = {'processingStatus': 'images_ready', 'pageCount': n_pages, 'dedupedPages': merged}
+            # Merged images won't pass through linking_worker again, so bubble up their entities here
+            if merged_ents: update['draftEntities'] = firestore.ArrayUnion(list(merged_ents))
+            fref.update(update)
 
-    except Exception as e:
-        print(f"Ingest Error: {traceback.format_exc()}")
-        fref.update({'processingStatus': 'error', 'error_ingest': str(e)})
+        except Exception as e:
+            trace.fail(e)
+            fref.update({'processingStatus': 'error', 'error_ingest': str(e)})
 
 # --------------------------------------------------------------------------------
 # CALLABLES (Standard UI Hooks)
@@ -524,30 +835,118 @@ def finalize_fanzine_data(req: https_fn.CallableRequest):
     _do_aggregation(req.data.get('fanzineId'))
     return {"success": True}
 
+@https_fn.on_call()
+def search_archive(req: https_fn.CallableRequest):
+    """Term, phrase and entity search over the index built by linking_worker.
+
+    Request data: `query` (words, "quoted phrases", entity:"Name"), optional
+    `pageSize`, `pageToken` and `groupBy` ('image' or 'fanzine').
+    """
+    query = req.data.get('query', '')
+    group_by = req.data.get('groupBy', 'image')
+    try:
+        page_size = max(1, min(int(req.data.get('pageSize', 20)), search_index.MAX_PAGE_SIZE))
+        offset = max(0, int(req.data.get('pageToken') or 0))
+    except (TypeError, ValueError):
+        raise https_fn.HttpsError(https_fn.FunctionsErrorCode.INVALID_ARGUMENT, "pageSize and pageToken must be integers.")
+
+    terms, phrases, entities = search_index.parse_query(query)
+    keys = list(dict.fromkeys(terms + [k for ph in phrases for k, _ in ph] + entities))
+    if not keys: return {'results': [], 'total': 0, 'truncated': False, 'nextPageToken': None}
+
+    db = firestore.client()
+    postings = db.collection('search_postings')
+    heads = db.collection('search_terms')
+    gens = {s.id: (s.to_dict() or {}).get('gens', {}) for s in db.get_all([heads.document(k) for k in keys]) if s.exists}
+
+    # Size every term's chunks (projected, so only the counters travel) and read the
+    # smallest term in full; it bounds the candidate set.
+    volume, existing = {k: 0 for k in keys}, {k: [] for k in keys}
+    all_refs = [postings.document(c) for k in keys for c in search_index.chunk_ids(k, gens.get(k))]
+    for snap in db.get_all(all_refs, field_paths=['term', 'size']):
+        if not snap.exists: continue
+        key = snap.id.rsplit('~', 1)[0]
+        existing[key].append(snap.id)
+        # Chunks written before sizes were tracked count as full
+        volume[key] += (snap.to_dict() or {}).get('size', search_index.CHUNK_MAX_BYTES)
+    driver = min(keys, key=lambda k: volume[k])
+    if not existing[driver]: return {'results': [], 'total': 0, 'truncated': False, 'nextPageToken': None}
+    driver_ids = existing[driver]
+    truncated = len(driver_ids) > search_index.MAX_QUERY_CHUNKS
+
+    per_image = {}
+    for snap in db.get_all([postings.document(c) for c in driver_ids[:search_index.MAX_QUERY_CHUNKS]]):
+        if not snap.exists: continue
+        for img_id, enc in (snap.to_dict() or {}).get('p', {}).items():
+            per_image[img_id] = {driver: enc}
+    if len(per_image) > search_index.MAX_QUERY_CANDIDATES:
+        truncated = True
+        best = sorted(per_image, key=lambda i: (-search_index.score(per_image[i]), i))[:search_index.MAX_QUERY_CANDIDATES]
+        per_image = {i: per_image[i] for i in best}
+
+    # Other terms: only the candidates' postings, from the lanes they live in.
+    by_lane = {}
+    for img_id in per_image: by_lane.setdefault(search_index.lane_for(img_id), []).append(img_id)
+    for key in keys:
+        if key == driver: continue
+        for lane, img_ids in by_lane.items():
+            refs = [postings.document(c) for c in search_index.chunk_ids(key, gens.get(key), lanes=[lane])]
+            for snap in db.get_all(refs, field_paths=[search_index.posting_field(i) for i in img_ids]):
+                if not snap.exists: continue
+                for img_id, enc in (snap.to_dict() or {}).get('p', {}).items():
+                    if img_id in per_image: per_image[img_id][key] = enc
+
+    hits = [(img_id, p) for img_id, p in per_image.items()
+            if len(p) == len(keys) and all(search_index.phrase_matches(ph, p) for ph in phrases)]
+    hits.sort(key=lambda h: (-search_index.score(h[1]), h[0]))
+
+    def fanzines_for(image_ids):
+        img_refs = [db.collection('images').document(i) for i in image_ids]
+        return {s.id: s.to_dict().get('usedInFanzines', []) for s in db.get_all(img_refs, field_paths=['usedInFanzines']) if s.exists}
+
+    if group_by == 'fanzine':
+        counts = {}
+        for fids in fanzines_for([i for i, _ in hits]).values():
+            for fid in fids: counts[fid] = counts.get(fid, 0) + 1
+        ranked = sorted(counts.items(), key=lambda c: (-c[1], c[0]))
+        results = [{'fanzineId': fid, 'matchingImages': n} for fid, n in ranked[offset:offset + page_size]]
+        total = len(ranked)
+    else:
+        page = hits[offset:offset + page_size]
+        used_in = fanzines_for([i for i, _ in page])
+        results = [{'imageId': i, 'fanzineIds': used_in.get(i, []), 'score': search_index.score(p)} for i, p in page]
+        total = len(hits)
+
+    next_offset = offset + page_size
+    return {'results': results, 'total': total, 'truncated': truncated,
+            'nextPageToken': str(next_offset) if next_offset < total else None}
+
 def _do_aggregation(fanzine_id):
     db = firestore.client()
     fref = db.collection('fanzines').document(fanzine_id)
-    try:
-        all_ents, creators, seen_c, indicia = set(), [], set(), []
-        pages = fref.collection('pages').order_by('pageNumber').stream()
-        for p in pages:
-            d = p.to_dict()
-            for e in d.get('detected_entities', []): all_ents.add(e)
-            if d.get('imageId'):
-                img = db.collection('images').document(d['imageId']).get().to_dict()
-                if img:
-                    if img.get('indicia'): indicia.append(img['indicia'])
-                    for c in img.get('creators', []):
-                        k = f"{c.get('uid')}_{c.get('role')}" if c.get('uid') else f"{c.get('name')}_{c.get('role')}"
-                        if k not in seen_c: seen_c.add(k); creators.append(c)
-        fref.update({
-            'draftEntities': list(all_ents),
-            'masterCreators': creators,
-            'masterIndicia': "\n\n".join(indicia),
-            'processingStatus': 'complete'
-        })
-    except Exception as e:
-        fref.update({'processingStatus': 'error', 'error_agg': str(e)})
+    with tracing.stage('aggregation', fanzine_ids=[fanzine_id]) as trace:
+        try:
+            all_ents, creators, seen_c, indicia = set(), [], set(), []
+            pages = fref.collection('pages').order_by('pageNumber').stream()
+            for p in pages:
+                d = p.to_dict()
+                for e in d.get('detected_entities', []): all_ents.add(e)
+                if d.get('imageId'):
+                    img = db.collection('images').document(d['imageId']).get().to_dict()
+                    if img:
+                        if img.get('indicia'): indicia.append(img['indicia'])
+                        for c in img.get('creators', []):
+                            k = f"{c.get('uid')}_{c.get('role')}" if c.get('uid') else f"{c.get('name')}_{c.get('role')}"
+                            if k not in seen_c: seen_c.add(k); creators.append(c)
+            fref.update({
+                'draftEntities': list(all_ents),
+                'masterCreators': creators,
+                'masterIndicia': "\n\n".join(indicia),
+                'processingStatus': 'complete'
+            })
+        except Exception as e:
+            trace.fail(e)
+            fref.update({'processingStatus': 'error', 'error_agg': str(e)})
 
 @storage_fn.on_object_finalized()
 def handle_pdf_upload(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
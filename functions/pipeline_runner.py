@@ -0,0 +1,508 @@
+"""Offline end-to-end runner for the ingest pipeline.
+
+Drives the real Cloud Functions in `main.py` against the Firestore and
+Storage emulators, with deterministic fake Vision and Gemini backends in
+place of the paid APIs:
+
+    firebase emulators:start --only firestore,storage --project demo-bqopd
+    export FIRESTORE_EMULATOR_HOST=127.0.0.1:8080
+    export STORAGE_EMULATOR_HOST=http://127.0.0.1:9199
+    python pipeline_runner.py --pages 20
+
+Trigger dispatch mimics production: every Firestore write made by a
+function (or by the runner standing in for the UI) is queued together with
+the before/after snapshots it produced, and each queued write invokes every
+`on_document_written` function whose document pattern matches. Invocations
+run on a pool of `--max-instances` threads (standing in for Cloud Functions
+max instances), so backend latency overlaps and hot documents contend the
+way they do in production; `--max-instances 1` runs them one at a time in
+write order. Firestore reads and writes
+are counted at the client library level so per-page costs can be compared
+between commits; the runner's own bookkeeping reads are excluded.
+"""
+import argparse
+import contextlib
+import functools
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+
+DEFAULT_PROJECT = 'demo-bqopd'
+DEFAULT_BUCKET = 'demo-bqopd.appspot.com'
+DEFAULT_MAX_INSTANCES = 16
+
+ENTITY_NAMES = ['Forrest J Ackerman', 'Harlan Ellison', 'Bob Tucker', 'Lee Hoffman', 'Walt Willis', 'Ray Bradbury']
+VOCAB = """
+fanzine mimeo letter column editorial convention fandom rocket review story
+issue cover art mailing apa stencil hektograph subscription trade contributor
+printing staples reprint fiction poetry news club meeting worldcon ditto
+""".split()
+
+
+class Latency:
+    """Deterministic artificial latency for the fake backends.
+
+    Each call sleeps `base_ms` +/- `jitter` (a fraction of `base_ms`), drawn
+    from a seeded RNG so repeated runs see the same delays.
+    """
+    def __init__(self, base_ms=0.0, jitter=0.0, seed=0):
+        self.base_ms = base_ms
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sleep(self):
+        if self.base_ms <= 0: return
+        spread = self.base_ms * self.jitter
+        with self._lock:
+            delay = max(0.0, self.base_ms + self._rng.uniform(-spread, spread))
+        time.sleep(delay / 1000.0)
+
+
+def fake_page_text(key):
+    """Returns the deterministic 'OCR' text for an image source."""
+    rng = random.Random(zlib.crc32(key.encode('utf-8') if isinstance(key, str) else key))
+    words = [rng.choice(VOCAB) for _ in range(120)]
+    for name in rng.sample(ENTITY_NAMES, 2):
+        words.insert(rng.randrange(len(words)), name)
+    lines = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+    return '\n'.join(lines)
+
+
+class FakeVisionClient:
+    """Stands in for `vision.ImageAnnotatorClient`."""
+    def __init__(self, backends):
+        self._backends = backends
+
+    def document_text_detection(self, image, retry=None, **kwargs):
+        self._backends.count('vision_calls')
+        self._backends.vision_latency.sleep()
+        key = image.source.image_uri or bytes(image.content)
+        return SimpleNamespace(
+            error=SimpleNamespace(message=''),
+            full_text_annotation=SimpleNamespace(text=fake_page_text(key)))
+
+
+class _FakeModels:
+    def __init__(self, backends):
+        self._backends = backends
+
+    def generate_content(self, model, contents, config=None):
+        self._backends.count('gemini_calls')
+        self._backends.gemini_latency.sleep()
+        prompt = contents[0]
+        if prompt.startswith("Clean up"):
+            return SimpleNamespace(text=prompt.split("Text:\n", 1)[-1].strip())
+        if prompt.startswith("Identify"):
+            found = [n for n in ENTITY_NAMES if n in prompt]
+            return SimpleNamespace(text=json.dumps(found))
+        return SimpleNamespace(text='')
+
+
+class FakeGenaiClient:
+    """Stands in for `genai.Client`."""
+    def __init__(self, backends):
+        self.models = _FakeModels(backends)
+
+
+class FakeBackends:
+    """Fake Vision and Gemini APIs with configurable latency and call counts."""
+    def __init__(self, vision_latency_ms=0.0, gemini_latency_ms=0.0, jitter=0.0, seed=0):
+        self.vision_latency = Latency(vision_latency_ms, jitter, seed)
+        self.gemini_latency = Latency(gemini_latency_ms, jitter, seed + 1)
+        self.vision_calls = 0
+        self.gemini_calls = 0
+        self._lock = threading.Lock()
+
+    def count(self, attr):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    @contextlib.contextmanager
+    def installed(self, module):
+        """Swaps the fakes into `main` for the duration of the block."""
+        orig_vision = module.vision.ImageAnnotatorClient
+        orig_genai = module.genai.Client
+        module.vision.ImageAnnotatorClient = lambda *a, **kw: FakeVisionClient(self)
+        module.genai.Client = lambda *a, **kw: FakeGenaiClient(self)
+        try:
+            yield self
+        finally:
+            module.vision.ImageAnnotatorClient = orig_vision
+            module.genai.Client = orig_genai
+
+
+def _doc_path(name):
+    return name.split('/documents/', 1)[1]
+
+
+class FirestoreTap:
+    """Counts Firestore reads/writes and queues the snapshots each write produced.
+
+    Reads follow Firestore billing: one per document returned, and one for a
+    query that matches nothing. `written` holds (path, before, after) with
+    snapshots read right after the commit, so a trigger sees the state its
+    write produced rather than whatever later writes left behind. (With
+    concurrent invocations, two writers racing on one doc may still be
+    snapshotted in either order.)
+
+    Safe to use from several threads; pausing only affects the calling thread.
+    """
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.written = deque()
+        self._last = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._restore = []
+
+    @property
+    def _paused(self):
+        return getattr(self._local, 'paused', 0)
+
+    @contextlib.contextmanager
+    def paused(self):
+        self._local.paused = self._paused + 1
+        try:
+            yield
+        finally:
+            self._local.paused -= 1
+
+    def thread_writes(self):
+        """Writes counted so far on the calling thread."""
+        return getattr(self._local, 'writes', 0)
+
+    def _count(self, reads=0, writes=0):
+        if self._paused: return
+        self._local.writes = self.thread_writes() + writes
+        with self._lock:
+            self.reads += reads
+            self.writes += writes
+
+    def record(self, client, paths):
+        """Snapshots just-written docs and queues them for trigger dispatch."""
+        with self.paused():
+            snaps = {s.reference.path: s for s in client.get_all([client.document(p) for p in dict.fromkeys(paths)])}
+        with self._lock:
+            for path in paths:
+                self.written.append((path, self._last.get(path), snaps[path]))
+                self._last[path] = snaps[path]
+
+    def _wrap(self, owner, attr, make):
+        orig = getattr(owner, attr)
+        setattr(owner, attr, functools.wraps(orig)(make(orig)))
+        self._restore.append((owner, attr, orig))
+
+    def __enter__(self):
+        from google.cloud.firestore_v1 import batch, client, document, query
+        tap = self
+
+        def commit(orig):
+            def wrapper(self, *args, **kwargs):
+                paths = []
+                for pb in self._write_pbs:
+                    op = pb._pb.WhichOneof('operation')
+                    paths.append(_doc_path(pb.update.name if op == 'update' else pb.delete))
+                result = orig(self, *args, **kwargs)
+                if not tap._paused:
+                    tap._count(writes=len(paths))
+                    tap.record(self._client, paths)
+                return result
+            return wrapper
+
+        def delete(orig):
+            def wrapper(self, *args, **kwargs):
+                result = orig(self, *args, **kwargs)
+                if not tap._paused:
+                    tap._count(writes=1)
+                    tap.record(self._client, [self.path])
+                return result
+            return wrapper
+
+        def get(orig):
+            def wrapper(self, *args, **kwargs):
+                tap._count(reads=1)
+                return orig(self, *args, **kwargs)
+            return wrapper
+
+        def counted_stream(orig, minimum):
+            def wrapper(self, *args, **kwargs):
+                n = 0
+                for snap in orig(self, *args, **kwargs):
+                    n += 1
+                    yield snap
+                tap._count(reads=max(n, minimum))
+            return wrapper
+
+        self._wrap(batch.WriteBatch, 'commit', commit)
+        self._wrap(document.DocumentReference, 'delete', delete)
+        self._wrap(document.DocumentReference, 'get', get)
+        self._wrap(client.Client, 'get_all', lambda orig: counted_stream(orig, 0))
+        self._wrap(query.Query, 'stream', lambda orig: counted_stream(orig, 1))
+        return self
+
+    def __exit__(self, *exc):
+        while self._restore:
+            owner, attr, orig = self._restore.pop()
+            setattr(owner, attr, orig)
+        return False
+
+
+def _compile_pattern(pattern):
+    regex = re.sub(r'\\\{(\w+)\\\}', r'(?P<\1>[^/]+)', re.escape(pattern))
+    return re.compile(f"^{regex}$")
+
+
+def discover_triggers(module):
+    """Returns [(name, compiled_pattern, handler)] for every Firestore trigger.
+
+    Handlers are the undecorated functions, which take an already-parsed
+    event rather than a raw CloudEvent.
+    """
+    triggers = []
+    for name in sorted(dir(module)):
+        endpoint = getattr(getattr(module, name), '__firebase_endpoint__', None)
+        if not endpoint or not endpoint.eventTrigger: continue
+        pattern = endpoint.eventTrigger.get('eventFilterPathPatterns', {}).get('document')
+        if pattern:
+            triggers.append((name, _compile_pattern(pattern), getattr(module, name).__wrapped__))
+    return triggers
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile; 0.0 for an empty list."""
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+class RunStats:
+    """Timing and cost counters for one fanzine run."""
+    def __init__(self, pages):
+        self.pages = pages
+        self.wall_seconds = 0.0
+        self.reads = 0
+        self.writes = 0
+        self.invocations = 0
+        self.max_instances = 1
+        self.vision_calls = 0
+        self.gemini_calls = 0
+        self.final_status = None
+        self.page_errors = 0
+        self.stages = {}
+
+    def record(self, stage, seconds, active):
+        s = self.stages.setdefault(stage, {'invocations': 0, 'active': 0, 'latencies_ms': []})
+        s['invocations'] += 1
+        if active:
+            s['active'] += 1
+            s['latencies_ms'].append(seconds * 1000.0)
+
+    def summary(self):
+        per_page = max(self.pages, 1)
+        return {
+            'pages': self.pages,
+            'wall_seconds': round(self.wall_seconds, 3),
+            'pages_per_second': round(self.pages / self.wall_seconds, 2) if self.wall_seconds else 0.0,
+            'reads_per_page': round(self.reads / per_page, 2),
+            'writes_per_page': round(self.writes / per_page, 2),
+            'invocations_per_page': round(self.invocations / per_page, 2),
+            'max_instances': self.max_instances,
+            'vision_calls': self.vision_calls,
+            'gemini_calls': self.gemini_calls,
+            'final_status': self.final_status,
+            'page_errors': self.page_errors,
+            'stages': {
+                name: {
+                    'invocations': s['invocations'],
+                    'active': s['active'],
+                    'p50_ms': round(percentile(s['latencies_ms'], 50), 2),
+                    'p90_ms': round(percentile(s['latencies_ms'], 90), 2),
+                    'p99_ms': round(percentile(s['latencies_ms'], 99), 2),
+                }
+                for name, s in sorted(self.stages.items())
+            },
+        }
+
+
+def synthetic_pdf(n_pages, seed=0):
+    """Builds an n-page PDF whose pages are all visually distinct."""
+    import fitz  # PyMuPDF
+    doc = fitz.open()
+    for i in range(n_pages):
+        rng = random.Random(seed * 1_000_003 + i)
+        page = doc.new_page(width=612, height=792)
+        for _ in range(14):
+            x, y = rng.uniform(20, 480), rng.uniform(20, 700)
+            shade = rng.uniform(0.1, 0.8)
+            page.draw_rect(fitz.Rect(x, y, x + rng.uniform(40, 110), y + rng.uniform(20, 80)), color=None, fill=(shade, shade, shade))
+        page.insert_text((40, 760), f"Synthetic fanzine page {i + 1}", fontsize=14)
+        for line in range(6):
+            page.insert_text((40, 40 + line * 16), ' '.join(rng.choice(VOCAB) for _ in range(8)), fontsize=11)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def init_emulator_app(project=DEFAULT_PROJECT, bucket=DEFAULT_BUCKET):
+    """Initializes Firebase Admin against the emulators and imports `main`.
+
+    Raises:
+        RuntimeError: If the emulator hosts are not configured, so the runner
+            can never write to a real project.
+    """
+    missing = [v for v in ('FIRESTORE_EMULATOR_HOST', 'STORAGE_EMULATOR_HOST') if not os.environ.get(v)]
+    if missing:
+        raise RuntimeError(f"Refusing to run without emulators; set {', '.join(missing)}.")
+
+    os.environ.setdefault('GCLOUD_PROJECT', project)
+    os.environ.setdefault('FIREBASE_CONFIG', json.dumps({'projectId': project, 'storageBucket': bucket}))
+    os.environ.setdefault('GEMINI_API_KEY', 'fake-key')
+
+    import firebase_admin
+    from firebase_admin import credentials
+    from google.auth.credentials import AnonymousCredentials
+
+    class EmulatorCredential(credentials.Base):
+        def get_credential(self):
+            return AnonymousCredentials()
+
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(EmulatorCredential(), {'projectId': project, 'storageBucket': bucket})
+
+    import main
+    return main
+
+
+class PipelineRunner:
+    """Runs PDFs through the full pipeline and collects `RunStats`."""
+    def __init__(self, module, backends=None, max_events_per_page=200, max_instances=DEFAULT_MAX_INSTANCES):
+        self.main = module
+        self.backends = backends or FakeBackends()
+        self.max_events_per_page = max_events_per_page
+        self.max_instances = max(1, max_instances)
+        self.triggers = discover_triggers(module)
+        self._stats_lock = threading.Lock()
+
+    def _firestore_event(self, before, snap, params):
+        before = before if before is not None and before.exists else None
+        after = snap if snap.exists else None
+        return SimpleNamespace(data=SimpleNamespace(before=before, after=after), params=params)
+
+    def _invoke(self, tap, stats, stage, handler, event):
+        writes_before = tap.thread_writes()
+        start = time.perf_counter()
+        handler(event)
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            stats.invocations += 1
+            stats.record(stage, elapsed, tap.thread_writes() > writes_before)
+
+    def _dispatch(self, tap, budget):
+        """Pops every queued write; returns ([(stage, handler, event)], budget)."""
+        calls = []
+        while tap.written:
+            path, before, snap = tap.written.popleft()
+            for name, pattern, handler in self.triggers:
+                m = pattern.match(path)
+                if not m: continue
+                budget -= 1
+                if budget < 0:
+                    raise RuntimeError("Pipeline did not settle; a trigger is probably re-firing itself.")
+                stage = name
+                if name == 'fanzine_traffic_manager' and snap.exists:
+                    stage = f"{name}[{snap.to_dict().get('processingStatus', 'idle')}]"
+                calls.append((stage, handler, self._firestore_event(before, snap, m.groupdict())))
+        return calls, budget
+
+    def _drain(self, tap, stats, budget, pool):
+        if pool is None:
+            while tap.written:
+                calls, budget = self._dispatch(tap, budget)
+                for call in calls: self._invoke(tap, stats, *call)
+            return budget
+
+        pending = set()
+        while tap.written or pending:
+            calls, budget = self._dispatch(tap, budget)
+            pending.update(pool.submit(self._invoke, tap, stats, *call) for call in calls)
+            if not pending: continue
+            # New writes are only queued by running invocations, so wake when one finishes.
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done: future.result()
+        return budget
+
+    def run_pdf(self, pdf_bytes, pages, name=None):
+        """Uploads a PDF, runs every stage through aggregation and returns stats."""
+        db = self.main.firestore.client()
+        bucket = self.main.storage.bucket()
+        path = f"uploads/raw_pdfs/{name or 'bench_' + uuid.uuid4().hex[:8]}.pdf"
+        stats = RunStats(pages)
+        stats.max_instances = self.max_instances
+        budget = self.max_events_per_page * max(pages, 1)
+        calls_before = (self.backends.vision_calls, self.backends.gemini_calls)
+
+        pool = ThreadPoolExecutor(self.max_instances) if self.max_instances > 1 else None
+        with FirestoreTap() as tap, self.backends.installed(self.main), (pool or contextlib.nullcontext()):
+            with tap.paused():
+                bucket.blob(path).upload_from_string(pdf_bytes, content_type='application/pdf')
+
+            start = time.perf_counter()
+            upload_event = SimpleNamespace(data=SimpleNamespace(name=path, bucket=bucket.name, metadata={'uploaderId': 'pipeline_runner'}))
+            t0 = time.perf_counter()
+            self.main.handle_pdf_upload.__wrapped__(upload_event)
+            stats.invocations += 1
+            stats.record('handle_pdf_upload', time.perf_counter() - t0, True)
+            budget = self._drain(tap, stats, budget, pool)
+
+            with tap.paused():
+                fanzines = list(db.collection('fanzines').where(filter=self.main.firestore.FieldFilter('sourceFile', '==', path)).stream())
+            if not fanzines: raise RuntimeError(f"handle_pdf_upload created no fanzine for {path}.")
+            fref = fanzines[0].reference
+
+            # Stand in for the editor pressing "finalize" once OCR has settled.
+            with tap.paused():
+                fref.update({'processingStatus': 'ready_for_agg'})
+            tap.record(db, [fref.path])
+            self._drain(tap, stats, budget, pool)
+            stats.wall_seconds = time.perf_counter() - start
+
+            with tap.paused():
+                stats.final_status = fref.get().to_dict().get('processingStatus')
+                stats.page_errors = sum(1 for p in fref.collection('pages').stream() if p.to_dict().get('status') == 'error')
+
+        stats.reads, stats.writes = tap.reads, tap.writes
+        stats.vision_calls = self.backends.vision_calls - calls_before[0]
+        stats.gemini_calls = self.backends.gemini_calls - calls_before[1]
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a synthetic fanzine through the pipeline on the emulators.")
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--vision-latency-ms', type=float, default=0.0)
+    parser.add_argument('--gemini-latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0, help="Latency spread as a fraction of the base latency.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-instances', type=int, default=DEFAULT_MAX_INSTANCES,
+                        help="Concurrent function invocations; 1 runs them serially in write order.")
+    args = parser.parse_args()
+
+    module = init_emulator_app()
+    backends = FakeBackends(args.vision_latency_ms, args.gemini_latency_ms, args.jitter, args.seed)
+    stats = PipelineRunner(module, backends, max_instances=args.max_instances).run_pdf(synthetic_pdf(args.pages, args.seed), args.pages)
+    print(json.dumps(stats.summary(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
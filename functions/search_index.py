@@ -0,0 +1,191 @@
+"""Inverted full-text and entity index over pipeline output.
+
+Each image contributes two kinds of terms:
+
+* ``t:<token>`` for every normalized word of ``text_corrected``, with the
+  word positions it occurs at (so quoted phrases can be matched), and
+* ``e:<entity>`` for every entry of ``detected_entities``.
+
+Each posting is a map entry ``p.<imageId> -> positions`` where positions
+are delta-encoded base-36 numbers joined by ``.``. Postings for a term are
+spread over ``POSTING_LANES`` lanes by image id, so the pages of one fanzine
+being linked at once don't all write the same doc. Each lane is a chain of
+chunk docs ``<term>~<lane>`` then ``<term>~<lane>.<gen>``: a chunk tracks
+its approximate ``size`` and, once it passes ``CHUNK_MAX_BYTES``, new
+postings spill into the next gen. The head doc ``search_terms/<term>``
+records the current gen of each lane and is only written on a spill.
+(``search_postings.p`` is exempt from indexing in firestore.indexes.json;
+otherwise every posting would be an index entry and a chunk would stop
+accepting writes long before 1 MiB.)
+
+A forward doc per image keeps its last indexed terms and the gen each
+posting went to, so re-indexing only writes the postings whose positions
+actually changed.
+
+Query cost: a query reads one head doc per term and the ``size`` of every
+chunk of every term (a projection, so billed per doc but tiny on the wire).
+It then reads the chunks of the term with the fewest posting bytes in full
+(at most ``MAX_QUERY_CHUNKS``), and for the other terms only the postings of
+the first ``MAX_QUERY_CANDIDATES`` candidates.
+"""
+import re
+import unicodedata
+import zlib
+
+POSTING_LANES = 8
+CHUNK_MAX_BYTES = 512 * 1024  # Half the 1 MiB doc limit, as headroom for concurrent writers
+MAX_TERM_LENGTH = 64
+MAX_PAGE_SIZE = 100
+MAX_QUERY_CHUNKS = 64
+MAX_QUERY_CANDIDATES = 2000
+
+# Too common to be worth a posting list. They still take up a position, so
+# phrases containing them keep the right spacing between indexed words.
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have he her his i if in is it its
+of on or our she so that the their them they this to was we were with you
+""".split())
+
+_WIKILINK = re.compile(r'\[\[([^\]|]+)(?:\|[^\]]*)?\]\]')
+_TOKEN = re.compile(r'[a-z0-9]+')
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+_SIMPLE_FIELD = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def tokenize(text):
+    """Lowercases, folds accents and splits text into word tokens."""
+    if not text: return []
+    text = _WIKILINK.sub(r'\1', text)
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+    text = re.sub(r"['`]", '', text.lower())
+    return _TOKEN.findall(text)
+
+
+def term_key(token):
+    return f"t:{token[:MAX_TERM_LENGTH]}"
+
+
+def entity_key(entity):
+    return f"e:{'_'.join(tokenize(entity))[:MAX_TERM_LENGTH]}"
+
+
+def _to36(n):
+    out = ''
+    while True:
+        n, r = divmod(n, 36)
+        out = _DIGITS[r] + out
+        if not n: return out
+
+
+def encode_positions(positions):
+    """Delta-encodes sorted positions as a compact base-36 string."""
+    prev, parts = 0, []
+    for p in positions:
+        parts.append(_to36(p - prev))
+        prev = p
+    return '.'.join(parts)
+
+
+def decode_positions(encoded):
+    if not encoded: return []
+    positions, total = [], 0
+    for part in encoded.split('.'):
+        total += int(part, 36)
+        positions.append(total)
+    return positions
+
+
+def build_terms(text, entities):
+    """Builds the {term_key: encoded_positions} map for one image."""
+    positions = {}
+    for pos, token in enumerate(tokenize(text)):
+        if token in STOPWORDS: continue
+        positions.setdefault(term_key(token), []).append(pos)
+    terms = {key: encode_positions(pos) for key, pos in positions.items()}
+    for ent in entities or []:
+        key = entity_key(ent)
+        if key != 'e:': terms[key] = ''
+    return terms
+
+
+def diff_terms(old_terms, new_terms):
+    """Returns (upserts, removals) needed to move postings from old to new."""
+    old_terms = old_terms or {}
+    upserts = {k: v for k, v in new_terms.items() if k not in old_terms or old_terms[k] != v}
+    removals = [k for k in old_terms if k not in new_terms]
+    return upserts, removals
+
+
+def lane_for(image_id):
+    return zlib.crc32(image_id.encode('utf-8')) % POSTING_LANES
+
+
+def posting_doc_id(key, lane, gen=0):
+    """Chunk doc id; gen 0 keeps the original ``<term>~<lane>`` form."""
+    return f"{key}~{lane}" if not gen else f"{key}~{lane}.{gen}"
+
+
+def chunk_ids(key, gens, lanes=None):
+    """Every chunk doc id of a term, given its head doc's ``gens`` map."""
+    gens = gens or {}
+    return [posting_doc_id(key, lane, gen)
+            for lane in (range(POSTING_LANES) if lanes is None else lanes)
+            for gen in range(gens.get(str(lane), 0) + 1)]
+
+
+def posting_size(image_id, encoded):
+    """Approximate bytes a posting adds to its chunk (Firestore doc size rules)."""
+    return len(image_id) + 1 + len(encoded) + 1
+
+
+def posting_field(image_id):
+    """Field path of an image's posting, quoted for use in a projection."""
+    if _SIMPLE_FIELD.match(image_id): return f"p.{image_id}"
+    return "p.`" + image_id.replace('\\', '\\\\').replace('`', '\\`') + "`"
+
+
+def parse_query(query):
+    """Splits a query into plain terms, quoted phrases and entities.
+
+    `entity:"Some Name"` (or `entity:name`) restricts to detected entities;
+    other double-quoted spans are phrases; everything else is AND-ed terms.
+
+    Returns:
+        (term_keys, phrases, entity_keys) where each phrase is a list of
+        (term_key, offset) pairs for its indexed words.
+    """
+    entities = []
+    def take_entity(m):
+        entities.append(entity_key(m.group(1) or m.group(2)))
+        return ' '
+    query = re.sub(r'entity:(?:"([^"]+)"|(\S+))', take_entity, query or '')
+
+    phrases = []
+    def take_phrase(m):
+        words = [(term_key(t), i) for i, t in enumerate(tokenize(m.group(1))) if t not in STOPWORDS]
+        if words: phrases.append(words)
+        return ' '
+    query = re.sub(r'"([^"]+)"', take_phrase, query)
+
+    terms = [term_key(t) for t in tokenize(query) if t not in STOPWORDS]
+    return list(dict.fromkeys(terms)), phrases, [e for e in dict.fromkeys(entities) if e != 'e:']
+
+
+def phrase_matches(phrase, postings):
+    """True if every word of `phrase` occurs at its offset from a common start.
+
+    Args:
+        phrase: List of (term_key, offset) pairs from `parse_query`.
+        postings: {term_key: encoded_positions} for a single image.
+    """
+    first_key, first_off = phrase[0]
+    starts = {p - first_off for p in decode_positions(postings.get(first_key))}
+    for key, off in phrase[1:]:
+        starts &= {p - off for p in decode_positions(postings.get(key))}
+        if not starts: return False
+    return bool(starts)
+
+
+def score(postings):
+    """Ranks an image by how often the query terms occur on it."""
+    return sum(len(v.split('.')) if v else 1 for v in postings.values())
@@ -0,0 +1,64 @@
+import unittest
+
+from PIL import Image, ImageDraw, ImageFilter
+
+import dedup
+
+
+def make_page(seed, size=(612, 792)):
+    """Draws a synthetic page of blocks whose layout depends on `seed`."""
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    for i in range(12):
+        x = (seed * 97 + i * 53) % (size[0] - 120)
+        y = (seed * 31 + i * 71) % (size[1] - 80)
+        draw.rectangle([x, y, x + 100, y + 60], fill=(i * 20 % 255, 0, 0))
+    return img
+
+
+class TestPerceptualHash(unittest.TestCase):
+    def test_hash_is_stable_across_scale_and_blur(self):
+        page = make_page(1)
+        rescan = page.resize((1224, 1584)).filter(ImageFilter.GaussianBlur(1))
+        self.assertLessEqual(dedup.hamming(dedup.dhash(page), dedup.dhash(rescan)), dedup.DEFAULT_MAX_DISTANCE)
+
+    def test_different_pages_are_far_apart(self):
+        self.assertGreater(dedup.hamming(dedup.dhash(make_page(1)), dedup.dhash(make_page(2))), 40)
+
+    def test_hash_length_matches_bits(self):
+        self.assertEqual(len(dedup.dhash(make_page(3))), dedup.HASH_SIZE * dedup.HASH_SIZE // 4)
+
+    def test_blank_page_is_low_information(self):
+        self.assertTrue(dedup.is_low_information(Image.new("RGB", (612, 792), "white")))
+        self.assertFalse(dedup.is_low_information(make_page(4)))
+
+    def test_bands_share_a_value_within_pigeonhole_distance(self):
+        h = dedup.dhash(make_page(5))
+        # Flip one bit in each of the first HASH_BANDS - 1 bands
+        flipped = int(h, 16)
+        band_bits = len(h) * 4 // dedup.HASH_BANDS
+        for band in range(dedup.HASH_BANDS - 1):
+            flipped ^= 1 << (band * band_bits)
+        other = f"{flipped:0{len(h)}x}"
+        self.assertEqual(dedup.hamming(h, other), dedup.HASH_BANDS - 1)
+        self.assertTrue(set(dedup.hash_bands(h)) & set(dedup.hash_bands(other)))
+
+    def test_uniform_bands_are_not_indexed(self):
+        h = "00" * 4 + "ab" * 4 + "ff" * 4 + "00" * 20
+        self.assertEqual(dedup.hash_bands(h), ["1:abababab"])
+        self.assertEqual(dedup.hash_bands("00" * 32), [])
+
+    def test_ranked_matches_are_closest_first(self):
+        h = "00" * 32
+        candidates = [("0f" + "00" * 31, "four"), ("ff" * 32, "far"), ("01" + "00" * 31, "one")]
+        self.assertEqual(dedup.ranked_matches(h, candidates, 6), [("one", 1), ("four", 4)])
+
+    def test_best_match_picks_closest_within_threshold(self):
+        h = "00" * 32
+        candidates = [("0f" + "00" * 31, "four"), ("01" + "00" * 31, "one"), ("ff" * 32, "far")]
+        self.assertEqual(dedup.best_match(h, candidates, 6), ("one", 1))
+        self.assertEqual(dedup.best_match(h, [("ff" * 32, "far")], 6), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pipeline_runner
+
+EMULATORS_UP = bool(os.environ.get('FIRESTORE_EMULATOR_HOST') and os.environ.get('STORAGE_EMULATOR_HOST'))
+
+
+class FakeClient:
+    """Snapshots whatever `state` holds for a path, like a get_all after a commit."""
+    def __init__(self): self.state = {}
+    def document(self, path): return path
+    def get_all(self, refs):
+        return [SimpleNamespace(reference=SimpleNamespace(path=p), value=self.state.get(p), exists=True,
+                                to_dict=lambda: {}) for p in refs]
+
+
+class TestPipelineRunnerHelpers(unittest.TestCase):
+    def test_trigger_patterns_capture_params(self):
+        pattern = pipeline_runner._compile_pattern("fanzines/{fanzineId}/pages/{pageId}")
+        m = pattern.match("fanzines/f1/pages/p9")
+        self.assertEqual(m.groupdict(), {'fanzineId': 'f1', 'pageId': 'p9'})
+        self.assertIsNone(pattern.match("fanzines/f1"))
+        self.assertIsNone(pipeline_runner._compile_pattern("images/{imageId}").match("images/a/b"))
+
+    def test_tap_queues_the_snapshot_each_write_produced(self):
+        tap, client = pipeline_runner.FirestoreTap(), FakeClient()
+        client.state['fanzines/f1'] = 'extracting_images'
+        tap.record(client, ['fanzines/f1'])
+        client.state['fanzines/f1'] = 'images_ready'
+        tap.record(client, ['fanzines/f1'])
+        first, second = tap.written
+        self.assertEqual((first[1], first[2].value), (None, 'extracting_images'))
+        self.assertEqual((second[1].value, second[2].value), ('extracting_images', 'images_ready'))
+
+    def test_percentile_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(pipeline_runner.percentile(values, 50), 50)
+        self.assertEqual(pipeline_runner.percentile(values, 99), 99)
+        self.assertEqual(pipeline_runner.percentile([7.0], 90), 7.0)
+        self.assertEqual(pipeline_runner.percentile([], 50), 0.0)
+
+    def test_fake_backends_are_deterministic(self):
+        backends = pipeline_runner.FakeBackends()
+        image = SimpleNamespace(source=SimpleNamespace(image_uri="gs://b/page_001.jpg"), content=b'')
+        vision = pipeline_runner.FakeVisionClient(backends)
+        text = vision.document_text_detection(image).full_text_annotation.text
+        self.assertEqual(text, vision.document_text_detection(image).full_text_annotation.text)
+
+        models = pipeline_runner.FakeGenaiClient(backends).models
+        cleaned = models.generate_content("m", [f"Clean up this.\n\nText:\n{text}"]).text
+        self.assertEqual(cleaned, text.strip())
+        ents = models.generate_content("m", [f"Identify people in this text: {text}"]).text
+        self.assertTrue(any(name in ents for name in pipeline_runner.ENTITY_NAMES))
+        self.assertEqual((backends.vision_calls, backends.gemini_calls), (2, 2))
+
+    def test_run_stats_summary(self):
+        stats = pipeline_runner.RunStats(pages=4)
+        stats.wall_seconds, stats.reads, stats.writes, stats.invocations = 2.0, 40, 20, 30
+        stats.record('ocr_worker', 0.010, True)
+        stats.record('ocr_worker', 0.001, False)
+        summary = stats.summary()
+        self.assertEqual(summary['pages_per_second'], 2.0)
+        self.assertEqual(summary['reads_per_page'], 10.0)
+        self.assertEqual(summary['invocations_per_page'], 7.5)
+        self.assertEqual(summary['stages']['ocr_worker']['invocations'], 2)
+        self.assertEqual(summary['stages']['ocr_worker']['p50_ms'], 10.0)
+
+    def test_synthetic_pdf_page_count(self):
+        import fitz  # PyMuPDF
+        doc = fitz.open(stream=pipeline_runner.synthetic_pdf(3), filetype="pdf")
+        self.assertEqual(len(doc), 3)
+        doc.close()
+
+
+class TestDispatch(unittest.TestCase):
+    def make_runner(self, max_instances, handler):
+        runner = pipeline_runner.PipelineRunner(SimpleNamespace(), max_instances=max_instances)
+        runner.triggers = [('page_worker', pipeline_runner._compile_pattern("pages/{pageId}"), handler)]
+        return runner
+
+    def drain(self, runner, tap, paths):
+        tap.record(FakeClient(), paths)
+        stats = pipeline_runner.RunStats(len(paths))
+        pool = ThreadPoolExecutor(runner.max_instances) if runner.max_instances > 1 else None
+        try:
+            runner._drain(tap, stats, 100, pool)
+        finally:
+            if pool: pool.shutdown()
+        return stats
+
+    def test_invocations_overlap_up_to_max_instances(self):
+        lock, running, peak = threading.Lock(), [0], [0]
+        def handler(event):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock: running[0] -= 1
+
+        stats = self.drain(self.make_runner(4, handler), pipeline_runner.FirestoreTap(), [f"pages/p{i}" for i in range(8)])
+        self.assertEqual(stats.invocations, 8)
+        self.assertEqual(peak[0], 4)
+
+    def test_serial_mode_follows_write_order_including_new_writes(self):
+        tap, seen = pipeline_runner.FirestoreTap(), []
+        def handler(event):
+            seen.append(event.params['pageId'])
+            if event.params['pageId'] == 'p0':
+                tap._count(writes=1)
+                tap.record(FakeClient(), ['pages/p9'])
+
+        stats = self.drain(self.make_runner(1, handler), tap, ['pages/p0', 'pages/p1'])
+        self.assertEqual(seen, ['p0', 'p1', 'p9'])
+        self.assertEqual(stats.summary()['stages']['page_worker']['active'], 1)
+
+
+@unittest.skipUnless(EMULATORS_UP, "Firestore/Storage emulators not running")
+class TestPipelineEndToEnd(unittest.TestCase):
+    def test_small_fanzine_completes(self):
+        module = pipeline_runner.init_emulator_app()
+        runner = pipeline_runner.PipelineRunner(module)
+        self.assertIn('ocr_worker', [name for name, _, _ in runner.triggers])
+        stats = runner.run_pdf(pipeline_runner.synthetic_pdf(3), 3)
+        self.assertEqual(stats.final_status, 'complete')
+        self.assertEqual(stats.page_errors, 0)
+        self.assertEqual(stats.vision_calls, 3)
+        self.assertGreater(stats.writes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+import search_index
+
+
+class TestSearchIndex(unittest.TestCase):
+    def test_tokenize_normalizes_text(self):
+        self.assertEqual(
+            search_index.tokenize("Café [[Harlan Ellison|user:abc]] didn't # WRITE"),
+            ['cafe', 'harlan', 'ellison', 'didnt', 'write'])
+
+    def test_positions_round_trip(self):
+        positions = [0, 3, 40, 41, 1300]
+        encoded = search_index.encode_positions(positions)
+        self.assertEqual(search_index.decode_positions(encoded), positions)
+        self.assertEqual(encoded, '0.3.11.1.yz')
+
+    def test_build_terms_skips_stopwords_but_keeps_positions(self):
+        terms = search_index.build_terms("The Hobbit and the hobbit", ["J.R.R. Tolkien"])
+        self.assertNotIn('t:the', terms)
+        self.assertEqual(search_index.decode_positions(terms['t:hobbit']), [1, 4])
+        self.assertEqual(terms['e:j_r_r_tolkien'], '')
+
+    def test_diff_only_touches_changed_terms(self):
+        old = search_index.build_terms("zines about robots", [])
+        new = search_index.build_terms("zines about robots and rockets", [])
+        upserts, removals = search_index.diff_terms(old, new)
+        self.assertEqual(upserts, {'t:rockets': '4'})
+        self.assertEqual(removals, [])
+        upserts, removals = search_index.diff_terms(new, {})
+        self.assertEqual(upserts, {})
+        self.assertEqual(sorted(removals), sorted(new))
+
+    def test_parse_query(self):
+        terms, phrases, entities = search_index.parse_query('robots "lord of the rings" entity:"Harlan Ellison"')
+        self.assertEqual(terms, ['t:robots'])
+        self.assertEqual(phrases, [[('t:lord', 0), ('t:rings', 3)]])
+        self.assertEqual(entities, ['e:harlan_ellison'])
+
+    def test_phrase_matches_requires_adjacent_positions(self):
+        _, phrases, _ = search_index.parse_query('"lord of the rings"')
+        hit = search_index.build_terms("I read the Lord of the Rings twice", [])
+        miss = search_index.build_terms("Lord Dunsany wrote of rings", [])
+        self.assertTrue(search_index.phrase_matches(phrases[0], hit))
+        self.assertFalse(search_index.phrase_matches(phrases[0], miss))
+
+    def test_lane_is_stable(self):
+        lane = search_index.lane_for('abc123')
+        self.assertEqual(lane, search_index.lane_for('abc123'))
+        self.assertTrue(0 <= lane < search_index.POSTING_LANES)
+        self.assertEqual(search_index.posting_doc_id('t:x', lane), f't:x~{lane}')
+        self.assertEqual(search_index.posting_doc_id('t:x', lane, 2), f't:x~{lane}.2')
+
+    def test_chunk_ids_follow_spilled_gens(self):
+        self.assertEqual(len(search_index.chunk_ids('t:x', None)), search_index.POSTING_LANES)
+        self.assertEqual(search_index.chunk_ids('t:x', {'3': 2}, lanes=[3]), ['t:x~3', 't:x~3.1', 't:x~3.2'])
+        self.assertEqual(len(search_index.chunk_ids('t:x', {'3': 2})), search_index.POSTING_LANES + 2)
+
+    def test_posting_field_quotes_non_identifier_ids(self):
+        self.assertEqual(search_index.posting_field('abc_1'), 'p.abc_1')
+        self.assertEqual(search_index.posting_field('0abc'), 'p.`0abc`')
+        self.assertEqual(search_index.posting_size('abc', '0.3'), 8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+import json
+import os
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+os.environ.setdefault('FIREBASE_CONFIG', json.dumps({'projectId': 'demo-bqopd', 'storageBucket': 'demo-bqopd.appspot.com'}))
+os.environ.setdefault('GCLOUD_PROJECT', 'demo-bqopd')
+
+from google.cloud.firestore_v1 import transforms
+
+import main
+import search_index
+
+
+class FakeSnapshot:
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return json.loads(json.dumps(self._data)) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self):
+        self._db.reads += 1
+        return FakeSnapshot(self, self._db.docs.get(self.path))
+
+    def update(self, fields):
+        self._db.apply(self.path, fields, merge=True)
+
+
+class FakeCollection:
+    def __init__(self, db, path):
+        self._db = db
+        self._path = path
+
+    def document(self, doc_id):
+        return FakeDocument(self._db, f"{self._path}/{doc_id}")
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, ref, fields, merge=False):
+        self._ops.append((ref.path, fields, merge))
+
+    def update(self, ref, fields):
+        self._ops.append((ref.path, fields, True))
+
+    def commit(self, **kwargs):
+        self._db.batch_sizes.append(len(self._ops))
+        for path, fields, merge in self._ops:
+            self._db.apply(path, fields, merge)
+
+
+class FakeFirestore:
+    """Just enough of the Firestore client for the search index code."""
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+        self.batch_sizes = []
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def get_all(self, refs, field_paths=None):
+        for ref in refs:
+            self.reads += 1
+            data = self.docs.get(ref.path)
+            if data is not None and field_paths is not None:
+                data = self._project(data, field_paths)
+            yield FakeSnapshot(ref, data)
+
+    @staticmethod
+    def _project(data, field_paths):
+        out = {}
+        for fp in field_paths:
+            parts = [p.strip('`') for p in fp.split('.', 1)]
+            if len(parts) == 1:
+                if parts[0] in data: out[parts[0]] = data[parts[0]]
+            elif parts[1] in data.get(parts[0], {}):
+                out.setdefault(parts[0], {})[parts[1]] = data[parts[0]][parts[1]]
+        return out
+
+    def apply(self, path, fields, merge):
+        if not merge: self.docs[path] = {}
+        self._merge(self.docs.setdefault(path, {}), fields)
+
+    def _merge(self, into, fields):
+        for key, value in fields.items():
+            if value is main.firestore.DELETE_FIELD:
+                into.pop(key, None)
+            elif value is main.firestore.SERVER_TIMESTAMP:
+                into[key] = 'now'
+            elif isinstance(value, transforms.Increment):
+                into[key] = into.get(key, 0) + value.value
+            elif isinstance(value, transforms.Maximum):
+                into[key] = max(into.get(key, value.value), value.value)
+            elif isinstance(value, dict):
+                self._merge(into.setdefault(key, {}), value)
+            else:
+                into[key] = value
+
+
+def _search(**data):
+    # Unwrap the on_call (Flask request) layer down to the function body
+    return main.search_archive.__wrapped__.__wrapped__(SimpleNamespace(data=data))
+
+
+class SearchIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeFirestore()
+        patches = [
+            patch.object(main.firestore, 'client', return_value=self.db),
+            patch.object(main.tracing, '_write_rollup'),
+            patch('builtins.print'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def index(self, image_id, text, entities=(), fanzines=('f1',)):
+        self.db.docs.setdefault(f"images/{image_id}", {'usedInFanzines': list(fanzines)})
+        main._update_search_index(self.db, image_id, text, list(entities))
+
+
+class TestUpdateSearchIndex(SearchIndexTestCase):
+    def test_postings_and_forward_doc(self):
+        self.index('img1', "Rocket review rocket", ['Bob Tucker'])
+        lane = search_index.lane_for('img1')
+        chunk = self.db.docs[f"search_postings/t:rocket~{lane}"]
+        self.assertEqual(chunk['p'], {'img1': '0.2'})
+        self.assertEqual(chunk['size'], search_index.posting_size('img1', '0.2'))
+        fwd = self.db.docs['search_docs/img1']
+        self.assertEqual(set(fwd['terms']), {'t:rocket', 't:review', 'e:bob_tucker'})
+        self.assertEqual(fwd['gens'], {})
+
+    def test_full_chunk_spills_and_removal_uses_recorded_gen(self):
+        with patch.object(search_index, 'POSTING_LANES', 1), patch.object(search_index, 'CHUNK_MAX_BYTES', 10):
+            self.index('img1', "rocket")
+            self.index('img2', "rocket")
+            self.assertEqual(self.db.docs['search_terms/t:rocket']['gens'], {'0': 1})
+            self.assertEqual(self.db.docs['search_postings/t:rocket~0.1']['p'], {'img2': '0'})
+            self.assertEqual(self.db.docs['search_docs/img2']['gens'], {'t:rocket': 1})
+
+            # Re-indexing keeps an existing posting where it is and removes from the right gen
+            self.index('img2', "rocket stencil")
+            self.assertEqual(self.db.docs['search_postings/t:rocket~0.1']['p'], {'img2': '0'})
+            self.index('img2', "stencil")
+            self.assertEqual(self.db.docs['search_postings/t:rocket~0.1']['p'], {})
+            self.assertEqual(self.db.docs['search_postings/t:rocket~0.1']['size'], 0)
+            self.assertEqual(self.db.docs['search_postings/t:rocket~0']['p'], {'img1': '0'})
+            self.assertEqual(self.db.docs['search_docs/img2']['gens'], {})
+
+    def test_large_pages_split_into_batches_of_400(self):
+        self.index('img1', ' '.join(f"word{i}" for i in range(900)))
+        self.assertEqual(self.db.batch_sizes, [400, 400, 101])
+        self.assertEqual(len(self.db.docs['search_docs/img1']['terms']), 900)
+
+    def test_unchanged_text_writes_nothing(self):
+        self.index('img1', "rocket review")
+        self.db.batch_sizes.clear()
+        self.index('img1', "rocket review")
+        self.assertEqual(self.db.batch_sizes, [])
+
+
+class TestIndexingRequeue(SearchIndexTestCase):
+    def linking_event(self, data):
+        ref = self.db.collection('images').document('img1')
+        return SimpleNamespace(params={'imageId': 'img1'}, data=SimpleNamespace(after=SimpleNamespace(
+            exists=True, reference=ref, to_dict=lambda: dict(data))))
+
+    def test_failure_requeues_until_attempts_run_out(self):
+        self.db.docs['images/img1'] = {'text_corrected': 'rocket', 'usedInFanzines': ['f1']}
+        with patch.object(main, '_update_search_index', side_effect=RuntimeError("contention")):
+            main._run_search_indexing(self.db, 'img1', 'rocket', [], ['f1'])
+            img = self.db.docs['images/img1']
+            self.assertEqual((img['needs_indexing'], img['indexing_attempts']), (True, 1))
+
+            for _ in range(main.MAX_INDEX_ATTEMPTS - 1):
+                main.linking_worker.__wrapped__(self.linking_event(self.db.docs['images/img1']))
+            img = self.db.docs['images/img1']
+            self.assertEqual((img['needs_indexing'], img['indexing_attempts']), (False, main.MAX_INDEX_ATTEMPTS))
+            self.assertEqual(img['errorLog_indexing'], 'contention')
+
+    def test_requeued_success_clears_the_flags(self):
+        self.db.docs['images/img1'] = {'text_corrected': 'rocket', 'usedInFanzines': ['f1'],
+                                       'needs_indexing': True, 'indexing_attempts': 1, 'errorLog_indexing': 'x'}
+        main.linking_worker.__wrapped__(self.linking_event(self.db.docs['images/img1']))
+        img = self.db.docs['images/img1']
+        self.assertNotIn('needs_indexing', img)
+        self.assertNotIn('errorLog_indexing', img)
+        self.assertIn('t:rocket', self.db.docs['search_docs/img1']['terms'])
+
+
+class TestSearchArchive(SearchIndexTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index('a', "the fanzine reviewed the lord of the rings", ['Harlan Ellison'], fanzines=['f1'])
+        self.index('b', "lord dunsany wrote of rings in this fanzine", [], fanzines=['f1', 'f2'])
+        self.index('c', "fanzine fanzine fanzine news", [], fanzines=['f2'])
+
+    def ids(self, result):
+        return [r['imageId'] for r in result['results']]
+
+    def test_terms_are_anded_and_ranked(self):
+        self.assertEqual(self.ids(_search(query="fanzine")), ['c', 'a', 'b'])
+        self.assertEqual(self.ids(_search(query="fanzine rings")), ['a', 'b'])
+        self.assertEqual(_search(query="rocket")['total'], 0)
+
+    def test_phrases_and_entities(self):
+        self.assertEqual(self.ids(_search(query='"lord of the rings"')), ['a'])
+        self.assertEqual(self.ids(_search(query='fanzine entity:"Harlan Ellison"')), ['a'])
+
+    def test_rare_term_is_not_lost_behind_a_common_one(self):
+        for i in range(20):
+            self.index(f"z{i:02d}", "fanzine " * 5)
+        with patch.object(search_index, 'MAX_QUERY_CANDIDATES', 5):
+            result = _search(query='fanzine entity:"Harlan Ellison"')
+        self.assertEqual(self.ids(result), ['a'])
+        self.assertFalse(result['truncated'])
+
+    def test_paging_and_grouping(self):
+        first = _search(query="fanzine", pageSize=2)
+        self.assertEqual((self.ids(first), first['nextPageToken'], first['total']), (['c', 'a'], '2', 3))
+        second = _search(query="fanzine", pageSize=2, pageToken=first['nextPageToken'])
+        self.assertEqual((self.ids(second), second['nextPageToken']), (['b'], None))
+        grouped = _search(query="fanzine", groupBy='fanzine')
+        self.assertEqual(grouped['results'], [{'fanzineId': 'f1', 'matchingImages': 2}, {'fanzineId': 'f2', 'matchingImages': 2}])
+
+
+if __name__ == '__main__':
+    unittest.main()
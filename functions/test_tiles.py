@@ -0,0 +1,59 @@
+import threading
+import unittest
+
+from PIL import Image
+
+import tiles
+
+
+class TestTilePyramid(unittest.TestCase):
+    def test_max_level_covers_longest_side(self):
+        self.assertEqual(tiles.max_level(1224, 1584), 11)
+        self.assertEqual(tiles.max_level(256, 256), 8)
+        self.assertEqual(tiles.max_level(1, 1), 0)
+
+    def test_level_dimensions_halve_and_round_up(self):
+        self.assertEqual(tiles.level_dimensions(1224, 1584, 11), (1224, 1584))
+        self.assertEqual(tiles.level_dimensions(1224, 1584, 10), (612, 792))
+        self.assertEqual(tiles.level_dimensions(1225, 1585, 10), (613, 793))
+        self.assertEqual(tiles.level_dimensions(1224, 1584, 0), (1, 1))
+
+    def test_tile_box_adds_overlap_inside_bounds(self):
+        self.assertEqual(tiles.tile_box(0, 0, 600, 300), (0, 0, 257, 257))
+        self.assertEqual(tiles.tile_box(1, 1, 600, 300), (255, 255, 513, 300))
+        self.assertEqual(tiles.tile_box(2, 0, 600, 300), (511, 0, 600, 257))
+
+    def test_manifest_lists_every_level(self):
+        manifest = tiles.build_manifest(600, 300, "https://x/{level}/{col}_{row}")
+        self.assertEqual(manifest['maxLevel'], 10)
+        self.assertEqual(len(manifest['levels']), 11)
+        top = manifest['levels'][-1]
+        self.assertEqual((top['width'], top['height'], top['cols'], top['rows']), (600, 300, 3, 2))
+        self.assertEqual(manifest['tileSize'], tiles.TILE_SIZE)
+
+    def test_generate_tiles_uploads_full_pyramid(self):
+        img = Image.new("RGB", (600, 300), (200, 10, 10))
+        uploaded = {}
+        lock = threading.Lock()
+
+        def upload(level, col, row, data):
+            with lock:
+                uploaded[(level, col, row)] = data
+
+        count = tiles.generate_tiles(img, upload, max_workers=4)
+        manifest = tiles.build_manifest(600, 300, "")
+        expected = sum(lvl['cols'] * lvl['rows'] for lvl in manifest['levels'])
+        self.assertEqual(count, expected)
+        self.assertEqual(len(uploaded), expected)
+        self.assertTrue(uploaded[(10, 2, 1)].startswith(b'RIFF'))
+
+    def test_generate_tiles_propagates_upload_errors(self):
+        def upload(level, col, row, data):
+            raise IOError("bucket unavailable")
+
+        with self.assertRaises(IOError):
+            tiles.generate_tiles(Image.new("RGB", (64, 64)), upload)
+
+
+if __name__ == '__main__':
+    unittest.main()
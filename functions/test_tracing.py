@@ -0,0 +1,123 @@
+import io
+import json
+import unittest
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import tracing
+
+
+class TestStageTracing(unittest.TestCase):
+    def run_stage(self, body, **kwargs):
+        out = io.StringIO()
+        with patch.object(tracing, '_write_rollup') as rollup, redirect_stdout(out):
+            try:
+                with tracing.stage('ocr', **kwargs) as trace:
+                    body(trace)
+            except RuntimeError:
+                pass
+        return trace, json.loads(out.getvalue().splitlines()[-1]), rollup
+
+    def test_successful_stage_logs_structured_record(self):
+        def body(trace):
+            trace.add_bytes(bytes_in=100, bytes_out=40)
+            with trace.external_call('vision'):
+                pass
+            trace.add_gemini_usage(SimpleNamespace(usage_metadata=SimpleNamespace(prompt_token_count=12, candidates_token_count=5)))
+
+        trace, record, rollup = self.run_stage(body, fanzine_ids=['f1', None], page_id='p1')
+        self.assertEqual(record['severity'], 'INFO')
+        self.assertEqual(record['stage'], 'ocr')
+        self.assertEqual(record['fanzineIds'], ['f1'])
+        self.assertEqual(record['pageId'], 'p1')
+        self.assertEqual((record['bytesIn'], record['bytesOut']), (100, 40))
+        self.assertEqual(record['external']['vision']['calls'], 1)
+        self.assertEqual((record['promptTokens'], record['outputTokens']), (12, 5))
+        self.assertGreaterEqual(record['wallMs'], 0)
+        rollup.assert_called_once_with(trace)
+
+    def test_handled_failure_is_recorded(self):
+        def body(trace):
+            try:
+                raise ValueError("Vision API Error: quota")
+            except ValueError as e:
+                trace.fail(e)
+
+        trace, record, _ = self.run_stage(body, fanzine_ids=['f1'])
+        self.assertEqual(record['severity'], 'ERROR')
+        self.assertEqual(record['error'], "Vision API Error: quota")
+        self.assertIn('ValueError', record['traceback'])
+        self.assertEqual(trace.rollup()['errors'], 1)
+
+    def test_escaping_exception_is_recorded_and_reraised(self):
+        def body(trace):
+            raise RuntimeError("boom")
+
+        _, record, _ = self.run_stage(body)
+        self.assertEqual(record['status'], 'error')
+
+    def test_rollup_failure_never_breaks_the_stage(self):
+        out = io.StringIO()
+        with patch.object(tracing, '_write_rollup', side_effect=IOError("offline")), redirect_stdout(out):
+            with tracing.stage('tiles', fanzine_ids=['f1']):
+                pass
+        self.assertIn('metrics rollup failed', out.getvalue())
+
+    def test_rollup_counters(self):
+        trace = tracing.StageTrace('linking', ['f1'])
+        with trace.external_call('gemini'):
+            pass
+        trace.retry()
+        counters = trace.rollup()
+        self.assertEqual(counters['count'], 1)
+        self.assertEqual(counters['externalCalls'], 1)
+        self.assertEqual(counters['retries'], 1)
+        self.assertEqual(counters['errors'], 0)
+        self.assertEqual(counters['sharedWallMs'], 0)
+
+    def test_shared_image_time_is_flagged(self):
+        trace = tracing.StageTrace('ocr', ['f1', 'f2'])
+        trace.wall_ms = 120.0
+        self.assertEqual(trace.rollup()['sharedWallMs'], 120.0)
+
+    def test_retry_policy_counts_retried_errors(self):
+        from google.api_core import exceptions, retry as api_retry
+        trace = tracing.StageTrace('ocr', ['f1'])
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3: raise exceptions.ServiceUnavailable("try again")
+            return 'ok'
+        policy = trace.retry_policy(api_retry.Retry(predicate=api_retry.if_transient_error, initial=0.001, maximum=0.001))
+        self.assertEqual(policy(flaky)(), 'ok')
+        self.assertEqual(trace.retries, 2)
+
+    def test_retry_policy_deadline(self):
+        from google.api_core import exceptions, retry as api_retry
+        trace = tracing.StageTrace('ocr', ['f1'])
+        self.assertEqual(trace.retry_policy(timeout=30)._timeout, 30)
+        self.assertEqual(trace.retry_policy(api_retry.Retry(timeout=120))._timeout, 120)
+        def down():
+            raise exceptions.ServiceUnavailable("outage")
+        policy = trace.retry_policy(api_retry.Retry(predicate=api_retry.if_transient_error, initial=0.01, maximum=0.01), timeout=0.05)
+        with self.assertRaises(exceptions.RetryError):
+            policy(down)()
+        self.assertGreater(trace.retries, 0)
+
+    def test_rollup_writes_one_shard_per_fanzine_in_one_batch(self):
+        trace = tracing.StageTrace('tiles', ['f1', 'f2'])
+        with patch('firebase_admin.firestore.client') as client:
+            tracing._write_rollup(trace)
+        db = client.return_value
+        batch = db.batch.return_value
+        self.assertEqual(batch.set.call_count, 2)
+        batch.commit.assert_called_once_with(timeout=tracing.ROLLUP_TIMEOUT_S)
+        db.collection.assert_called_with(tracing.METRICS_COLLECTION)
+        shard_ids = {c.args[0] for c in db.collection.return_value.document.return_value.collection.return_value.document.call_args_list}
+        self.assertEqual(len(shard_ids), 1)
+        self.assertTrue(0 <= int(shard_ids.pop()) < tracing.METRIC_SHARDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
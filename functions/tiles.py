@@ -0,0 +1,127 @@
+"""Deep-zoom tile pyramid generation for high-resolution page viewing.
+
+Pages are cut into a DZI-style pyramid: level ``max_level`` is the full
+resolution render, every level below it is half the size of the one above,
+down to a single 1x1 pixel at level 0. Each level is split into square
+``TILE_SIZE`` WebP tiles (with ``TILE_OVERLAP`` pixels of bleed so viewers
+can stitch without seams), so a zoomed-in reader only fetches the tiles that
+are actually on screen.
+"""
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+TILE_SIZE = 256
+TILE_OVERLAP = 1
+TILE_FORMAT = 'webp'
+TILE_QUALITY = 80
+
+
+def max_level(width, height):
+    """Returns the index of the full resolution level for an image."""
+    return int(math.ceil(math.log2(max(width, height, 1))))
+
+
+def level_dimensions(width, height, level):
+    """Returns the (width, height) of the image at a given pyramid level."""
+    scale = 2 ** (max_level(width, height) - level)
+    return max(1, math.ceil(width / scale)), max(1, math.ceil(height / scale))
+
+
+def tile_grid(level_w, level_h, tile_size=TILE_SIZE):
+    """Returns the (cols, rows) of tiles needed to cover a level."""
+    return math.ceil(level_w / tile_size), math.ceil(level_h / tile_size)
+
+
+def tile_box(col, row, level_w, level_h, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Returns the crop box of a tile, including overlap into its neighbours."""
+    left = max(0, col * tile_size - overlap)
+    top = max(0, row * tile_size - overlap)
+    right = min(level_w, (col + 1) * tile_size + overlap)
+    bottom = min(level_h, (row + 1) * tile_size + overlap)
+    return left, top, right, bottom
+
+
+def tile_path(prefix, level, col, row):
+    """Storage path of a single tile, following the DZI `_files` layout."""
+    return f"{prefix}/image_files/{level}/{col}_{row}.{TILE_FORMAT}"
+
+
+def build_manifest(width, height, tile_url_template):
+    """Builds the JSON manifest a viewer needs to request tiles.
+
+    `tile_url_template` must contain `{level}`, `{col}` and `{row}`
+    placeholders; the client fills them in for each visible tile.
+    """
+    levels = []
+    for level in range(max_level(width, height) + 1):
+        lw, lh = level_dimensions(width, height, level)
+        cols, rows = tile_grid(lw, lh)
+        levels.append({'level': level, 'width': lw, 'height': lh, 'cols': cols, 'rows': rows})
+    return {
+        'type': 'dzi',
+        'width': width,
+        'height': height,
+        'tileSize': TILE_SIZE,
+        'overlap': TILE_OVERLAP,
+        'format': TILE_FORMAT,
+        'maxLevel': max_level(width, height),
+        'levels': levels,
+        'tileUrlTemplate': tile_url_template,
+    }
+
+
+def iter_level_images(img):
+    """Yields (level, image) from full resolution down to level 0.
+
+    Each level is resampled from the one above it rather than from the
+    original, so the cost of the whole pyramid stays close to one resize.
+    """
+    width, height = img.size
+    current = img
+    for level in range(max_level(width, height), -1, -1):
+        size = level_dimensions(width, height, level)
+        if current.size != size:
+            current = current.resize(size, Image.Resampling.LANCZOS)
+        yield level, current
+
+
+def encode_tile(tile_img):
+    """Encodes a cropped tile to WebP bytes."""
+    out_io = BytesIO()
+    tile_img.save(out_io, format='WEBP', quality=TILE_QUALITY)
+    return out_io.getvalue()
+
+
+def generate_tiles(img, upload, max_workers=None):
+    """Cuts `img` into a tile pyramid and hands each encoded tile to `upload`.
+
+    `upload(level, col, row, data)` is called from worker threads. Pillow
+    releases the GIL while encoding, so a thread pool spreads WebP encoding
+    (and the network-bound uploads) across every available core.
+
+    Returns:
+        The number of tiles produced.
+    """
+    if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+    workers = max_workers or os.cpu_count() or 1
+
+    def work(job):
+        level, col, row, tile_img = job
+        upload(level, col, row, encode_tile(tile_img))
+
+    jobs = []
+    for level, level_img in iter_level_images(img):
+        lw, lh = level_img.size
+        cols, rows = tile_grid(lw, lh)
+        for col in range(cols):
+            for row in range(rows):
+                jobs.append((level, col, row, level_img.crop(tile_box(col, row, lw, lh))))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() re-raises the first worker exception, if any.
+        list(pool.map(work, jobs))
+    return len(jobs)
@@ -0,0 +1,194 @@
+"""Per-stage tracing and pipeline metrics.
+
+Wrap the body of each pipeline stage in `stage()`:
+
+    with tracing.stage('ocr', fanzine_ids=[fanzine_id], image_id=image_id) as trace:
+        with trace.external_call('vision'):
+            response = vision_client.document_text_detection(image=image)
+        ...
+
+When the block exits, one structured JSON line is printed (Cloud Logging
+parses these into `jsonPayload`, so they can be filtered by stage or
+fanzine). The counters are also rolled up with atomic increments into one
+of `METRIC_SHARDS` random shard docs under
+`pipeline_metrics/{fanzineId}/shards/`, which lets a status check spot which
+stage a slow fanzine is stuck in without reading every page. Sharding keeps
+a 1,000-page fanzine's burst of stage runs under Firestore's per-doc write
+rate; readers add the shards back together.
+
+An image shared by several fanzines is rolled up into each of them with its
+full wall time, so summing across fanzines double-counts it; that part of
+the time is also kept separately as `sharedWallMs`.
+"""
+import contextlib
+import json
+import random
+import threading
+import time
+import traceback
+
+METRICS_COLLECTION = 'pipeline_metrics'
+METRIC_SHARDS = 32
+ROLLUP_TIMEOUT_S = 5.0
+
+
+def _camel(key):
+    head, *rest = key.split('_')
+    return head + ''.join(w.title() for w in rest)
+
+
+class StageTrace:
+    """Counters for a single stage invocation. Safe to update from threads."""
+    def __init__(self, name, fanzine_ids=None, **context):
+        self.name = name
+        self.fanzine_ids = [f for f in (fanzine_ids or []) if f]
+        self.context = {_camel(k): v for k, v in context.items() if v is not None}
+        self.wall_ms = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.external = {}
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.retries = 0
+        self.error = None
+        self.error_traceback = None
+        self._lock = threading.Lock()
+
+    def add_bytes(self, bytes_in=0, bytes_out=0):
+        with self._lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    @contextlib.contextmanager
+    def external_call(self, service):
+        """Times a call to an outside service (Vision, Gemini, Storage...)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - start) * 1000.0
+            with self._lock:
+                stats = self.external.setdefault(service, {'calls': 0, 'ms': 0.0})
+                stats['calls'] += 1
+                stats['ms'] += ms
+
+    def add_gemini_usage(self, response):
+        """Adds token counts from a Gemini response, if it reports them."""
+        usage = getattr(response, 'usage_metadata', None)
+        with self._lock:
+            self.prompt_tokens += getattr(usage, 'prompt_token_count', None) or 0
+            self.output_tokens += getattr(usage, 'candidates_token_count', None) or 0
+
+    def retry(self):
+        """Counts one retried attempt at an external call or at the stage itself."""
+        with self._lock:
+            self.retries += 1
+
+    def retry_policy(self, base=None, timeout=None):
+        """A google-api-core `Retry` that counts each retryable error on this trace.
+
+        With `base` (e.g. Cloud Storage's DEFAULT_RETRY) its predicate, backoff
+        and deadline are kept; otherwise transient errors are retried. Pass
+        `timeout` to cap the total retry time, and keep it well under the
+        function's own timeout so a failure is still recorded before the
+        instance is killed.
+        """
+        from google.api_core import retry as api_retry
+        base = base or api_retry.Retry(predicate=api_retry.if_transient_error, maximum=10.0)
+        return api_retry.Retry(
+            predicate=base._predicate,
+            initial=base._initial,
+            maximum=base._maximum,
+            multiplier=base._multiplier,
+            timeout=timeout if timeout is not None else base._timeout,
+            on_error=lambda exc: self.retry()
+        )
+
+    def fail(self, exc):
+        """Marks the stage failed; call from the stage's own `except` block."""
+        self.error = str(exc)
+        self.error_traceback = traceback.format_exc()
+
+    def log_record(self):
+        """The structured log entry for this invocation."""
+        status = 'error' if self.error else 'ok'
+        record = {
+            'severity': 'ERROR' if self.error else 'INFO',
+            'message': f"stage {self.name} {status} in {self.wall_ms:.0f}ms",
+            'stage': self.name,
+            'status': status,
+            'fanzineIds': self.fanzine_ids,
+            'wallMs': round(self.wall_ms, 2),
+            'bytesIn': self.bytes_in,
+            'bytesOut': self.bytes_out,
+            'external': {k: {'calls': v['calls'], 'ms': round(v['ms'], 2)} for k, v in self.external.items()},
+            'promptTokens': self.prompt_tokens,
+            'outputTokens': self.output_tokens,
+            'retries': self.retries,
+        }
+        record.update(self.context)
+        if self.error:
+            record['error'] = self.error
+            record['traceback'] = self.error_traceback
+        return record
+
+    def rollup(self):
+        """Additive counters to fold into the fanzine's metrics doc."""
+        return {
+            'count': 1,
+            'errors': 1 if self.error else 0,
+            'wallMs': round(self.wall_ms, 2),
+            'bytesIn': self.bytes_in,
+            'bytesOut': self.bytes_out,
+            'externalCalls': sum(v['calls'] for v in self.external.values()),
+            'externalMs': round(sum(v['ms'] for v in self.external.values()), 2),
+            'promptTokens': self.prompt_tokens,
+            'outputTokens': self.output_tokens,
+            'retries': self.retries,
+            'sharedWallMs': round(self.wall_ms, 2) if len(self.fanzine_ids) > 1 else 0,
+        }
+
+
+def _write_rollup(trace):
+    if not trace.fanzine_ids: return
+    from firebase_admin import firestore
+    counters = trace.rollup()
+    stage_fields = {k: firestore.Increment(v) for k, v in counters.items()}
+    stage_fields['maxWallMs'] = firestore.Maximum(counters['wallMs'])
+    doc = {
+        'stages': {trace.name: stage_fields},
+        'lastStage': trace.name,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    }
+    if trace.error:
+        doc['lastError'] = f"{trace.name}: {trace.error}"
+        doc['lastErrorAt'] = firestore.SERVER_TIMESTAMP
+    db = firestore.client()
+    shard = str(random.randrange(METRIC_SHARDS))
+    batch = db.batch()
+    for fid in trace.fanzine_ids:
+        batch.set(db.collection(METRICS_COLLECTION).document(fid).collection('shards').document(shard), doc, merge=True)
+    batch.commit(timeout=ROLLUP_TIMEOUT_S)
+
+
+@contextlib.contextmanager
+def stage(name, fanzine_ids=None, **context):
+    """Traces one stage invocation; see the module docstring.
+
+    Exceptions escaping the block are recorded and re-raised. Metrics are
+    best-effort: a failed rollup write is logged, never raised.
+    """
+    trace = StageTrace(name, fanzine_ids, **context)
+    start = time.perf_counter()
+    try:
+        yield trace
+    except Exception as e:
+        trace.fail(e)
+        raise
+    finally:
+        trace.wall_ms = (time.perf_counter() - start) * 1000.0
+        print(json.dumps(trace.log_record()))
+        try:
+            _write_rollup(trace)
+        except Exception as e:
+            print(json.dumps({'severity': 'WARNING', 'message': f"metrics rollup failed for stage {name}: {e}"}))
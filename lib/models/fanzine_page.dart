@@ -9,6 +9,7 @@ class FanzinePage extends Equatable {
   final String? imageUrl;
   final String? gridUrl; // Added: 450px WebP thumbnail
   final String? listUrl; // Added: 800px WebP thumbnail
+  final String? tileManifestUrl; // Added: deep-zoom tile pyramid manifest
   final String? storagePath;
   final String status;
   final String? templateId;
@@ -29,6 +30,7 @@ class FanzinePage extends Equatable {
     this.imageUrl,
     this.gridUrl,
     this.listUrl,
+    this.tileManifestUrl,
     this.storagePath,
     required this.status,
     this.templateId,
@@ -49,6 +51,7 @@ class FanzinePage extends Equatable {
       imageUrl: data['imageUrl'],
       gridUrl: data['gridUrl'],
       listUrl: data['listUrl'],
+      tileManifestUrl: data['tileManifestUrl'],
       storagePath: data['storagePath'],
       status: data['status'] ?? 'ready',
       templateId: data['templateId'],
@@ -68,6 +71,7 @@ class FanzinePage extends Equatable {
     imageUrl,
     gridUrl,
     listUrl,
+    tileManifestUrl,
     storagePath,
     status,
     templateId,